@@ -1,6 +1,27 @@
-from .db_util import *
-from .dao import *
-from easyapi_tools.util import *
-from .handler import *
-from .controller import *
-from easyapi_tools.errors import *
\ No newline at end of file
+from easyapi_tools.lazy import lazy_exports
+
+# 属性在第一次访问时才导入对应的模块 只用到工具函数时不会加载 quart 和数据库驱动
+__getattr__, __dir__, __all__ = lazy_exports(__name__, (
+    ('.db_util', ('get_sync_engine', 'get_engine', 'MysqlDB', 'get_sync_sqlite_engine', 'is_read_sql',
+                  'compile_sql', 'BufferedRow', 'BufferedResultProxy', 'SqliteTransaction', 'SqliteConnection',
+                  'SqliteEngine', 'SqliteDB', 'get_sync_postgre_engine', 'get_postgre_pool', 'AsyncpgCompiler',
+                  'AsyncpgDialect', 'PostgreTransaction', 'PostgreConnection', 'PostgreEngine', 'PostgreDB',
+                  'TenantMysqlDB', 'current_tenant')),
+    ('.dao', ('Transaction', 'get_tx', 'search_sql', 'create_in_table', 'DaoMetaClass', 'BaseDao',
+              'BusinessBaseDao')),
+    ('easyapi_tools.util', ('AGGREGATE_FUNCTIONS', 'str2hump', 'type_to_json', 'page_number', 'page_range',
+                            'chunks', 'merge_sorted', 'match_query', 'parse_metric', 'Relation', 'AbcUrlCondition',
+                            'DefaultUrlCondition', 'parse_literal', 'column_literal', 'getlist',
+                            'QueryStringUrlCondition', 'make_etag', 'etag_matches')),
+    ('.handler', ('QuartHandlerMeta', 'QuartBaseHandler', 'subscribe_view', 'register_api')),
+    ('.controller', ('query_flight', 'ControllerMetaClass', 'BaseController')),
+    ('.buffer', ('InsertBuffer', )),
+    ('.change_feed', ('ChangeBus', )),
+    ('.sync_adapter', ('SyncController', )),
+    ('.permission', ('AbcPermission', )),
+    ('.ratelimit', ('TokenBucketLimiter', 'SharedTokenBucketLimiter')),
+    ('easyapi_tools.errors', ('BusinessError', 'ConflictError')),
+    ('easyapi_tools.query_guard', ('QueryGuard', 'QueryAdvisor', 'default_advisor')),
+    ('easyapi_tools.validator', ('AbcValidator', 'SchemaValidator')),
+    ('easyapi_tools.cache', ('TTLCache', )),
+))
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from .db_util import current_tenant
+
+logger = logging.getLogger(__name__)
+
+_CLOSE = object()
+
+
+class InsertBuffer(object):
+    """
+    异步批量写入缓冲 适用于审计 事件等只追加的表
+    数据先进入内存队列 按条数或时间批量 insert_many 写入
+    每行记录 put 时的 current_tenant 写入时按租户分组 在该租户下执行 insert_many
+    用法:
+        audit_buffer = InsertBuffer(AuditDao, max_batch=500, flush_interval=1)
+        await audit_buffer.start()
+        await audit_buffer.put({'action': 'login'})
+        await audit_buffer.close()
+    """
+
+    def __init__(self, dao, max_batch: int = 500, flush_interval: float = 1.0, max_pending: int = 10000,
+                 retries: int = 3, retry_delay: float = 0.5, durable: bool = False, on_error=None):
+        """
+        :param dao: 写入使用的dao 需要支持 insert_many
+        :param max_batch: 每批最多写入的行数
+        :param flush_interval: 一批数据最长等待的秒数
+        :param max_pending: 队列上限 超过后 put 会等待
+        :param retries: 写入失败的重试次数
+        :param retry_delay: 第一次重试的等待秒数 之后指数增长
+        :param durable: 默认是否等待数据真正写入
+        :param on_error: 重试后依然失败时的回调 on_error(rows, exception)
+        """
+        self.dao = dao
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.durable = durable
+        self.on_error = on_error
+        self.flushed = 0
+        self.failed = 0
+        self._queue = None
+        self._task = None
+        self._closed = False
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        """
+        启动后台写入任务 需要在事件循环中调用
+        :return:
+        """
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._closed = False
+        self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, data: dict, durable: bool = None):
+        """
+        写入一行 队列满时等待
+        :param data:
+        :param durable: 为 True 时等待该行写入数据库 失败时抛出异常
+        :return:
+        """
+        if self._closed or self._queue is None:
+            raise RuntimeError('InsertBuffer is not running')
+        if durable is None:
+            durable = self.durable
+        future = asyncio.get_event_loop().create_future() if durable else None
+        await self._queue.put((data, future, current_tenant.get()))
+        if self._task.done():
+            # 后台任务已经退出 不会再有人写入队列中的数据
+            self._fail_pending()
+        if future is not None:
+            await future
+
+    def put_nowait(self, data: dict):
+        """
+        不等待的写入 队列满时抛出 asyncio.QueueFull
+        :param data:
+        :return:
+        """
+        if self._closed or self._queue is None:
+            raise RuntimeError('InsertBuffer is not running')
+        self._queue.put_nowait((data, None, current_tenant.get()))
+
+    async def close(self):
+        """
+        停止接收数据 写完队列中剩余的数据后退出
+        :return:
+        """
+        if self._closed or self._task is None:
+            return
+        self._closed = True
+        if not self._task.done():
+            await self._queue.put(_CLOSE)
+        await self._task
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        batch = []
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is _CLOSE:
+                    return
+                batch = [item]
+                closing = False
+                deadline = loop.time() + self.flush_interval
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is _CLOSE:
+                        closing = True
+                        break
+                    batch.append(item)
+                try:
+                    await self._flush(batch)
+                except Exception as e:
+                    # 一批数据的异常不能结束后台任务
+                    logger.exception('InsertBuffer failed to flush %d rows into %s', len(batch),
+                                     self.dao.__tablename__)
+                    self._fail(batch, e)
+                batch = []
+                if closing:
+                    return
+        finally:
+            # 任务被取消或异常退出时 等待写入的 put 不能永远挂起
+            self._closed = True
+            self._fail(batch, RuntimeError('InsertBuffer stopped before the rows were written'))
+            self._fail_pending()
+
+    @staticmethod
+    def _fail(batch: list, error: BaseException):
+        for _, future, _ in batch:
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    def _fail_pending(self):
+        """
+        丢弃队列中还未写入的数据 等待写入的 put 抛出异常
+        :return:
+        """
+        pending = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _CLOSE:
+                pending.append(item)
+        if pending:
+            logger.error('InsertBuffer dropped %d pending rows for %s', len(pending), self.dao.__tablename__)
+            self.failed += len(pending)
+            self._fail(pending, RuntimeError('InsertBuffer is not running'))
+
+    async def _flush(self, batch: list):
+        # insert_many 要求每行字段一致 按租户和字段分组写入
+        groups = {}
+        for data, future, tenant in batch:
+            groups.setdefault((tenant, tuple(sorted(data.keys()))), []).append((data, future))
+        for (tenant, _), items in groups.items():
+            rows = [data for data, _ in items]
+            token = current_tenant.set(tenant)
+            try:
+                error = await self._insert(rows)
+            finally:
+                current_tenant.reset(token)
+            for _, future in items:
+                if future is None or future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    async def _insert(self, rows: list):
+        for attempt in range(self.retries + 1):
+            try:
+                await self.dao.insert_many(data_list=rows)
+            except Exception as e:
+                if attempt < self.retries:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                self.failed += len(rows)
+                logger.error('InsertBuffer failed to insert %d rows into %s: %s', len(rows),
+                             self.dao.__tablename__, e)
+                if self.on_error is not None:
+                    try:
+                        self.on_error(rows, e)
+                    except Exception:
+                        logger.exception('InsertBuffer on_error callback failed')
+                return e
+            self.flushed += len(rows)
+            return None
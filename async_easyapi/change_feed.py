@@ -0,0 +1,118 @@
+import asyncio
+import json
+from easyapi_tools.util import match_query
+from .db_util import current_tenant
+
+
+class Subscription(object):
+    """
+    一个订阅者 持有一个有界队列 满了之后丢弃最旧的事件
+    """
+
+    def __init__(self, bus, table: str, query: dict, max_queue: int = 100, tenant=None):
+        self.bus = bus
+        self.table = table
+        self.query = query
+        self.tenant = tenant
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize=max_queue)
+
+    def push(self, payload: str):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(payload)
+
+    async def get(self, timeout: float = None) -> str:
+        """
+        获取下一个事件
+        :param timeout: 超时返回 None
+        :return: json 字符串
+        """
+        if timeout is None:
+            return await self._queue.get()
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class ChangeBus(object):
+    """
+    进程内的数据变更总线
+    dao 设置 __change_bus__ 后 insert/update/delete 会发布事件
+    相同条件的订阅者共用一次匹配 每个事件只序列化一次
+    按 current_tenant 隔离 订阅者只收到订阅时所在租户的变更
+    """
+
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        # (tenant, table) -> {条件的key: (query, set(subscription))}
+        self._groups = {}
+
+    @staticmethod
+    def _query_key(query: dict) -> str:
+        return json.dumps(query or {}, sort_keys=True, default=str)
+
+    def subscribe(self, table: str, query: dict = None, tenant=None) -> Subscription:
+        """
+        订阅一张表的变更
+        :param table:
+        :param query: 过滤条件 与 search_sql 语义一致
+        :param tenant: 默认为 current_tenant
+        :return:
+        """
+        if tenant is None:
+            tenant = current_tenant.get()
+        subscription = Subscription(self, table, query or {}, self.max_queue, tenant)
+        groups = self._groups.setdefault((tenant, table), {})
+        key = self._query_key(subscription.query)
+        if key not in groups:
+            groups[key] = (subscription.query, set())
+        groups[key][1].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        group_key = (subscription.tenant, subscription.table)
+        groups = self._groups.get(group_key, {})
+        key = self._query_key(subscription.query)
+        if key in groups:
+            groups[key][1].discard(subscription)
+            if not groups[key][1]:
+                del groups[key]
+        if not groups:
+            self._groups.pop(group_key, None)
+
+    def subscribers(self, table: str = None) -> int:
+        return sum(len(subscriptions) for (_, name), groups in self._groups.items()
+                   if table is None or name == table for _, subscriptions in groups.values())
+
+    def publish(self, table: str, action: str, data: dict, tenant=None):
+        """
+        发布一个变更事件
+        update 的 data 为 条件 + 修改的字段 未知的字段在匹配时视为满足
+        :param table:
+        :param action: insert update delete
+        :param data:
+        :param tenant: 默认为 current_tenant
+        :return:
+        """
+        if tenant is None:
+            tenant = current_tenant.get()
+        groups = self._groups.get((tenant, table))
+        if not groups:
+            return
+        payload = None
+        for query, subscriptions in list(groups.values()):
+            if query and not match_query(query, data):
+                continue
+            if payload is None:
+                event = {'table': table, 'action': action, 'data': data}
+                if tenant is not None:
+                    event['tenant'] = tenant
+                payload = json.dumps(event, default=str)
+            for subscription in list(subscriptions):
+                subscription.push(payload)
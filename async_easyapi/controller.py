@@ -1,7 +1,13 @@
 import asyncio
 from easyapi_tools.errors import BusinessError
+from easyapi_tools.util import parse_metric
+from easyapi_tools.validator import SchemaValidator
 from sqlalchemy.exc import OperationalError, IntegrityError, DataError
 from datetime import datetime
+from .db_util import current_tenant
+from .singleflight import SingleFlight, flight_key
+
+query_flight = SingleFlight()
 
 
 class ControllerMetaClass(type):
@@ -10,11 +16,20 @@ class ControllerMetaClass(type):
             return type.__new__(cls, name, bases, attrs)
         if attrs.get('__dao__') is None:
             raise NotImplementedError("Should have __dao__ value.")
-        cls.__validator__ = attrs.get('__validator__', None)
+        validator = attrs.get('__validator__')
+        if isinstance(validator, dict):
+            validator = attrs['__validator__'] = SchemaValidator(validator)
+        if isinstance(validator, SchemaValidator):
+            validator.bind(attrs['__dao__'])
         return type.__new__(cls, name, bases, attrs)
 
 
 class BaseController(metaclass=ControllerMetaClass):
+    __validator__ = None
+    __aggregate_columns__ = ()
+    __relations__ = {}
+    __singleflight__ = False
+
     @classmethod
     def formatter(cls, data: dict):
         """
@@ -58,13 +73,98 @@ class BaseController(metaclass=ControllerMetaClass):
         :param sorter:
         :return:
         """
+        if cls.__singleflight__:
+            # 相同的并发查询共享一次数据库往返和同一个结果 调用方不应修改结果 不同租户的查询不合并
+            key = flight_key(cls.__module__, cls.__qualname__, current_tenant.get(), cls.__dao__.__tablename__,
+                             query, pager, sorter)
+            return await query_flight.do(key, cls._query, query, pager, sorter)
+        return await cls._query(query, pager, sorter)
+
+    @classmethod
+    async def _query(cls, query: dict, pager: dict, sorter: dict) -> (list, dict):
+        # 复制后再取出 _include 不修改调用方的 query (singleflight 的多个调用方共用同一个 query)
+        query = dict(query) if query else query
+        include = query.pop('_include', None) if query else None
         query = cls.reformatter(data=query)
         try:
             res, total = await asyncio.gather(cls.__dao__.query(query=query, pager=pager, sorter=sorter),
                                               cls.__dao__.count(query=query))
         except (OperationalError, IntegrityError, DataError) as e:
             raise BusinessError(code=500, http_code=500, err_info=str(e))
-        return list(map(cls.formatter, res)), total
+        data = list(map(cls.formatter, res))
+        if include:
+            await cls.include(include, res, data)
+        return data, total
+
+    @classmethod
+    async def include(cls, names: list, rows: list, results: list):
+        """
+        批量加载关联资源 每个关联只查询一次
+        :param names: 关联名 在 __relations__ 中声明 (也可以声明在dao上)
+        :param rows: dao 返回的原始数据
+        :param results: formatter 之后的结果
+        :return:
+        """
+        relations = dict(getattr(cls.__dao__, '__relations__', {}), **cls.__relations__)
+        names = list(dict.fromkeys(names))
+        for name in names:
+            if name not in relations:
+                raise BusinessError(code=400, http_code=400, err_info='unknown include {}'.format(name))
+
+        async def load(relation):
+            keys = relation.keys(rows)
+            if not keys:
+                return []
+            return await relation.dao.query(query=relation.query(keys))
+
+        try:
+            related = await asyncio.gather(*[load(relations[name]) for name in names])
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        for name, items in zip(names, related):
+            relations[name].stitch(name, rows, results, items)
+
+    @classmethod
+    async def version(cls, query: dict, *args, **kwargs):
+        """
+        满足条件的资源的版本 用于生成 ETag
+        :param query:
+        :return: dao 不支持版本时返回 None
+        """
+        query = cls.reformatter(data=query)
+        try:
+            return await cls.__dao__.version(query=query)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+
+    @classmethod
+    async def aggregate(cls, query: dict, group_by: list, metrics: list, *args, **kwargs) -> list:
+        """
+        分组聚合 只允许使用 __aggregate_columns__ 中的列
+        :param query:
+        :param group_by:
+        :param metrics:
+        :return:
+        """
+        if group_by is None:
+            group_by = []
+        if metrics is None:
+            metrics = ['count:*']
+        if not isinstance(group_by, list) or not isinstance(metrics, list):
+            raise BusinessError(code=400, http_code=400, err_info='_group_by and _metrics should be list')
+        try:
+            columns = group_by + [parse_metric(metric)[1] for metric in metrics]
+        except ValueError as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
+        for column in columns:
+            if column != '*' and column not in cls.__aggregate_columns__:
+                raise BusinessError(code=400, http_code=400, err_info='aggregate on {} is not allowed'.format(column))
+        query = cls.reformatter(data=query)
+        try:
+            res = await cls.__dao__.aggregate(query=query, group_by=group_by, metrics=metrics)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
 
     @classmethod
     async def insert(cls, data: dict,  *args, **kwargs):
@@ -83,6 +183,23 @@ class BaseController(metaclass=ControllerMetaClass):
             raise BusinessError(code=500, http_code=500, err_info=str(e))
         return res
 
+    @classmethod
+    async def insert_many(cls, data_list: list, *args, **kwargs):
+        """
+        批量插入资源 整批校验通过后一次写入
+        :param data_list:
+        :return: 插入的行数
+        """
+        if cls.__validator__ is not None:
+            err = cls.__validator__.validate_many(data_list)
+            if err is not None:
+                raise BusinessError(code=500, http_code=200, err_info=err)
+        try:
+            res = await cls.__dao__.insert_many(data_list=data_list)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
+
     @classmethod
     async def update(cls, id: int, data: dict,  *args, **kwargs):
         """
@@ -92,7 +209,7 @@ class BaseController(metaclass=ControllerMetaClass):
         :return:
         """
         if cls.__validator__ is not None:
-            err = cls.__validator__.validate(data)
+            err = cls.__validator__.validate_update(data)
             if err is not None:
                 raise BusinessError(code=500, http_code=200, err_info=err)
         query = {"id": id}
@@ -1,6 +1,13 @@
+import asyncio
 import functools
-from sqlalchemy.sql import select, and_, func, between, distinct, text
-from easyapi_tools.util import str2hump, type_to_json
+import uuid
+from sqlalchemy import MetaData, Table, Column
+from sqlalchemy.schema import CreateTable, DropTable
+from sqlalchemy.sql import select, and_, func, between, distinct, text, null, union_all
+from easyapi_tools.util import str2hump, type_to_json, page_range, chunks, merge_sorted, parse_metric
+from easyapi_tools.errors import ConflictError
+from easyapi_tools.compact import CompactPage
+from easyapi_tools.arrays import rows_to_arrays, concat_arrays
 from .db_util import MysqlDB
 from sqlalchemy.exc import NoSuchColumnError
 import datetime
@@ -19,7 +26,10 @@ class Transaction():
 
     async def __aexit__(self, exc_type, exc, tb):
         try:
-            await self._transaction.commit()
+            if exc_type is not None:
+                await self._transaction.rollback()
+            else:
+                await self._transaction.commit()
         except Exception as e:
             await self._transaction.rollback()
             raise e
@@ -60,6 +70,24 @@ def search_sql(sql, query: dict, table):
     return sql
 
 
+async def create_in_table(conn, column, values: list, chunk_size: int):
+    """
+    创建临时表 写入 in 查询的值
+    :param conn:
+    :param column: 被查询的列
+    :param values:
+    :param chunk_size:
+    :return:
+    """
+    tmp = Table('tmp_in_{}'.format(uuid.uuid4().hex[:16]), MetaData(),
+                Column('value', column.type, primary_key=True, autoincrement=False),
+                prefixes=['TEMPORARY'])
+    await conn.execute(CreateTable(tmp))
+    for chunk in chunks(values, chunk_size):
+        await conn.execute(tmp.insert().values([{'value': value} for value in chunk]))
+    return tmp
+
+
 class DaoMetaClass(type):
     """
         dao的元类 读取 db 和 table信息 生成
@@ -83,6 +111,16 @@ class DaoMetaClass(type):
 
 
 class BaseDao(metaclass=DaoMetaClass):
+    __query_guard__ = None
+    __change_bus__ = None
+    __relations__ = {}
+    __in_threshold__ = 1000
+    __in_strategy__ = 'chunk'
+    # 每次写入都会改变的列 用于计算数据版本(ETag) 为 None 时不支持版本
+    __modified_column__ = None
+    # 乐观锁的版本号列 修改时版本号加一 修改的数据带版本号时只修改该版本的数据 版本不一致时抛出 ConflictError
+    __version_column__ = None
+
     @classmethod
     def reformatter(cls, data: dict, *args, **kwargs):
         """
@@ -101,6 +139,46 @@ class BaseDao(metaclass=DaoMetaClass):
         """
         return type_to_json(data)
 
+    @classmethod
+    def _read_table(cls, *args, **kwargs):
+        """
+        查询使用的表 子类可以替换为视图或 union
+        :return:
+        """
+        return cls.__db__[cls.__tablename__]
+
+    @classmethod
+    async def id_batches(cls, ctx: dict = None, query: dict = None, batch_size: int = 1000, after_id=None, *args,
+                   **kwargs):
+        """
+        按主键顺序分批返回满足条件的 id 每批只查询 id 不使用 offset
+        用于分批修改 删除 调用方修改或删除本批数据不影响后续批次
+        :param ctx:
+        :param query:
+        :param batch_size:
+        :param after_id: 从该 id 之后开始 用于中断后继续
+        :return: 每次返回一批 id
+        """
+        if query is None:
+            query = {}
+        query = cls.reformatter(query, *args, **kwargs)
+        table = cls.__db__[cls.__tablename__]
+        while True:
+            sql = select([table.c.id])
+            if query:
+                sql = search_sql(sql, query, table)
+            if after_id is not None:
+                sql = sql.where(table.c.id > after_id)
+            sql = sql.order_by(table.c.id).limit(batch_size)
+            res = await cls.__db__.execute(ctx=ctx, sql=sql)
+            ids = [row[0] for row in await res.fetchall()]
+            if not ids:
+                return
+            yield ids
+            if len(ids) < batch_size:
+                return
+            after_id = ids[-1]
+
     @classmethod
     async def first(cls, ctx: dict = None, query=None, sorter_key: str = 'id', *args, **kwargs):
         """
@@ -112,7 +190,7 @@ class BaseDao(metaclass=DaoMetaClass):
         if query is None:
             query = {}
         query = cls.reformatter(query, *args, **kwargs)
-        table = cls.__db__[cls.__tablename__]
+        table = cls._read_table(*args, **kwargs)
         sql = select([table])
         if query:
             sql = search_sql(sql, query, table)
@@ -135,7 +213,7 @@ class BaseDao(metaclass=DaoMetaClass):
         if query is None:
             query = {}
         query = cls.reformatter(query, *args, **kwargs)
-        table = cls.__db__[cls.__tablename__]
+        table = cls._read_table(*args, **kwargs)
         sql = select([table])
         if query:
             sql = search_sql(sql, query, table)
@@ -157,7 +235,7 @@ class BaseDao(metaclass=DaoMetaClass):
         if query is None:
             query = {}
         query = cls.reformatter(query, *args, **kwargs)
-        table = cls.__db__[cls.__tablename__]
+        table = cls._read_table(*args, **kwargs)
         sql = select([table])
         if query:
             sql = search_sql(sql, query, table)
@@ -177,34 +255,179 @@ class BaseDao(metaclass=DaoMetaClass):
         :param sorter:
         :return:
         """
+        table, data = await cls._query_rows(ctx, query, pager, sorter, *args, **kwargs)
+        return list(map(functools.partial(cls.formatter, *args, **kwargs), data))
+
+    @classmethod
+    async def query_compact(cls, ctx: dict = None, query: dict = None, pager: dict = None, sorter: dict = None, *args,
+                            **kwargs) -> CompactPage:
+        """
+        与 query 相同的查询 结果按列存放 不为每行生成 dict 也不经过 formatter
+        用于大量数据的查询 CompactPage.dumps 直接序列化为 json
+        :param query:
+        :param pager:
+        :param sorter:
+        :return:
+        """
+        table, data = await cls._query_rows(ctx, query, pager, sorter, *args, **kwargs)
+        return CompactPage.from_rows(table, data, name=cls.__tablename__)
+
+    @classmethod
+    async def _query_rows(cls, ctx: dict, query: dict, pager: dict, sorter: dict, *args, **kwargs) -> (object, list):
+        """
+        query 的查询部分
+        :return: (查询的表, 原始的行)
+        """
         if query is None:
             query = {}
         query = cls.reformatter(query, *args, **kwargs)
-        table = cls.__db__[cls.__tablename__]
-        sql = select([table])
-        if query:
-            sql = search_sql(sql, query, table)
-        if pager is not None:
-            per_page = pager.get('_per_page')
-            page = pager.get('_page')
-            if per_page:
-                sql = sql.limit(per_page)
-            if page:
-                if per_page is None:
-                    sql = sql.offset((page - 1) * 30).limit(30)
-                else:
-                    sql = sql.offset((page - 1) * per_page)
+        table = cls._read_table(*args, **kwargs)
         if sorter is None:
             sorter = {}
-        order_by = sorter.get('_order_by', 'id')
+        order_by = getattr(table.c, sorter.get('_order_by', 'id'), table.c.id)
         desc = sorter.get('_desc', True)
-        if desc:
-            sql = sql.order_by(getattr(table.c, order_by, table.c.id).desc())
+        if cls.__query_guard__ is not None:
+            cls.__query_guard__.check(cls.__db__[cls.__tablename__], query, order_by.name)
+        offset, limit = page_range(pager)
+
+        def build(source, limit=limit, offset=offset):
+            sql = select([table]).select_from(source)
+            if query:
+                sql = search_sql(sql, query, table)
+            if limit:
+                sql = sql.limit(limit)
+            if offset:
+                sql = sql.offset(offset)
+            if desc:
+                return sql.order_by(order_by.desc())
+            return sql.order_by(order_by)
+
+        column, values, query = cls._split_large_in(query)
+        if column is None:
+            res = await cls.__db__.execute(ctx=ctx, sql=build(table))
+            data = await res.fetchall()
+        elif cls.__in_strategy__ == 'temp_table':
+            data = await cls._execute_with_in_table(ctx, table, column, values, build)
         else:
-            sql = sql.order_by(getattr(table.c, order_by, table.c.id))
-        res = await cls.__db__.execute(ctx=ctx, sql=sql)
-        data = await res.fetchall()
-        return list(map(functools.partial(cls.formatter, *args, **kwargs), data))
+            # 每个分片最多取 offset + limit 条 合并排序后再截取
+            sqls = [build(table, limit=(offset or 0) + limit if limit else None, offset=None).where(
+                getattr(table.c, column).in_(chunk)) for chunk in chunks(values, cls.__in_threshold__)]
+            results = await cls._execute_many(ctx, sqls)
+            data = merge_sorted([await res.fetchall() for res in results], order_by.name, desc, offset, limit)
+        return table, data
+
+    @classmethod
+    async def iter_columns(cls, ctx: dict = None, query: dict = None, columns: list = None, batch_size: int = 10000,
+                           *args, **kwargs):
+        """
+        按主键顺序分批读取指定的列 每批返回 {列名: numpy 数组} 用于分析任务
+        只查询需要的列 不生成 dict 也不经过 formatter 需要安装 numpy
+        :param query: 与 query 相同的条件
+        :param columns: 列名 默认为全部
+        :param batch_size: 每批的行数 为 None 时一次读取
+        :return: 没有数据时返回一批空数组
+        """
+        if query is None:
+            query = {}
+        query = cls.reformatter(query, *args, **kwargs)
+        table = cls._read_table(*args, **kwargs)
+        selected = [table.c[name] for name in columns] if columns else list(table.columns)
+        if cls.__query_guard__ is not None:
+            cls.__query_guard__.check(cls.__db__[cls.__tablename__], query, 'id')
+        # 按 id 翻页 没有选择 id 时额外查询
+        names = [column.name for column in selected]
+        with_id = 'id' in names
+        if not with_id:
+            selected.append(table.c.id)
+            names.append('id')
+        id_index = names.index('id')
+        after_id = None
+        while True:
+            sql = select(selected)
+            if query:
+                sql = search_sql(sql, query, table)
+            if after_id is not None:
+                sql = sql.where(table.c.id > after_id)
+            sql = sql.order_by(table.c.id)
+            if batch_size:
+                sql = sql.limit(batch_size)
+            res = await cls.__db__.execute(ctx=ctx, sql=sql)
+            rows = await res.fetchall()
+            if not rows and after_id is not None:
+                return
+            arrays = rows_to_arrays(selected, rows)
+            if not with_id:
+                del arrays['id']
+            yield arrays
+            if not batch_size or len(rows) < batch_size:
+                return
+            after_id = rows[-1][id_index]
+
+    @classmethod
+    async def fetch_columns(cls, ctx: dict = None, query: dict = None, columns: list = None, batch_size: int = None,
+                            *args, **kwargs) -> dict:
+        """
+        读取指定的列 返回 {列名: numpy 数组}
+        用法:
+            arrays = await OrderDao.fetch_columns(query={'_gt_created_at': '2018-01-01'}, columns=['user_id', 'amount'])
+            arrays['amount'].sum()
+        :param query: 与 query 相同的条件
+        :param columns: 列名 默认为全部
+        :param batch_size: 分批读取后合并 避免单条 sql 读取过多数据
+        :return:
+        """
+        batches = [batch async for batch in cls.iter_columns(ctx, query, columns, batch_size, *args, **kwargs)]
+        return concat_arrays(batches, list(batches[0]))
+
+    @classmethod
+    def _split_large_in(cls, query: dict) -> (str, list, dict):
+        """
+        找出超过阈值的 _in_ 条件 从query中拆出
+        :param query:
+        :return: (列名, 去重后的值, 剩余的query)
+        """
+        for k, v in query.items():
+            if k.startswith('_in_') and type(v) is list and len(v) > cls.__in_threshold__:
+                rest = dict(query)
+                del rest[k]
+                return k[4:], list(dict.fromkeys(v)), rest
+        return None, None, query
+
+    @classmethod
+    async def _execute_many(cls, ctx: dict, sqls: list) -> list:
+        """
+        并发执行多条sql 在事务中时顺序执行
+        :param ctx:
+        :param sqls:
+        :return:
+        """
+        if ctx is not None and ctx.get('connection') is not None:
+            return [await cls.__db__.execute(ctx=ctx, sql=sql) for sql in sqls]
+        return await asyncio.gather(*[cls.__db__.execute(ctx=ctx, sql=sql) for sql in sqls])
+
+    @classmethod
+    async def _execute_with_in_table(cls, ctx: dict, table, column: str, values: list, build) -> list:
+        """
+        将 in 的值写入临时表 join 后查询
+        :param ctx:
+        :param table:
+        :param column:
+        :param values:
+        :param build: 根据 join 生成sql
+        :return:
+        """
+        conn = None
+        if ctx is not None:
+            conn = ctx.get('connection', None)
+        if conn is None:
+            async with get_tx(cls.__db__) as conn:
+                return await cls._execute_with_in_table({'connection': conn}, table, column, values, build)
+        tmp = await create_in_table(conn, getattr(table.c, column), values, cls.__in_threshold__)
+        try:
+            res = await conn.execute(build(table.join(tmp, getattr(table.c, column) == tmp.c.value)))
+            return await res.fetchall()
+        finally:
+            await conn.execute(DropTable(tmp))
 
     @classmethod
     async def insert(cls, data: dict, ctx: dict = None, *args, **kwargs):
@@ -220,8 +443,34 @@ class BaseDao(metaclass=DaoMetaClass):
         data = cls.reformatter(data, *args, **kwargs)
         sql = table.insert().values(**data)
         res = await cls.__db__.execute(ctx=ctx, sql=sql)
+        cls._publish('insert', dict(data, id=res.lastrowid) if res.lastrowid else data)
         return res.lastrowid
 
+    @classmethod
+    async def insert_many(cls, data_list: list, ctx: dict = None, use_copy: bool = False, *args, **kwargs):
+        """
+        批量插入 每行的字段需要一致
+        :param data_list:
+        :param ctx:
+        :param use_copy: db 支持时(PostgreDB) 使用 COPY 写入
+        :return: 插入的行数
+        """
+        if not data_list:
+            return 0
+        table = cls.__db__[cls.__tablename__]
+        data_list = [cls.reformatter(data, *args, **kwargs) for data in data_list]
+        if use_copy and hasattr(cls.__db__, 'copy_records'):
+            columns = list(data_list[0].keys())
+            records = [tuple(data.get(column) for column in columns) for data in data_list]
+            rowcount = await cls.__db__.copy_records(table, columns, records, ctx=ctx)
+        else:
+            sql = table.insert().values(data_list)
+            res = await cls.__db__.execute(ctx=ctx, sql=sql)
+            rowcount = res.rowcount
+        for data in data_list:
+            cls._publish('insert', data)
+        return rowcount
+
     @classmethod
     async def count(cls, ctx: dict = None, query: dict = None, *args, **kwargs):
         """
@@ -232,13 +481,85 @@ class BaseDao(metaclass=DaoMetaClass):
         if query is None:
             query = {}
         query = cls.reformatter(query, *args, **kwargs)
+        table = cls._read_table(*args, **kwargs)
+        if cls.__query_guard__ is not None:
+            cls.__query_guard__.check(cls.__db__[cls.__tablename__], query, record=False)
+
+        def build(source):
+            sql = select([func.count('*')]).select_from(source)
+            if query:
+                sql = search_sql(sql, query, table)
+            return sql
+
+        column, values, query = cls._split_large_in(query)
+        if column is None:
+            res = await cls.__db__.execute(ctx=ctx, sql=build(table))
+            return await res.scalar()
+        if cls.__in_strategy__ == 'temp_table':
+            data = await cls._execute_with_in_table(ctx, table, column, values, build)
+            return data[0][0]
+        # 值已去重 各分片互不相交 计数直接相加
+        sqls = [build(table).where(getattr(table.c, column).in_(chunk)) for chunk in
+                chunks(values, cls.__in_threshold__)]
+        results = await cls._execute_many(ctx, sqls)
+        return sum([await res.scalar() for res in results])
+
+    @classmethod
+    async def version(cls, ctx: dict = None, query: dict = None, *args, **kwargs):
+        """
+        满足条件的数据的版本 (行数, 最大修改时间, 最大id) 任一行新增 修改 删除后都会变化
+        修改时间的精度与列的精度相同 同一精度内的多次修改无法区分
+        :param ctx:
+        :param query:
+        :return: 没有 __modified_column__ 时返回 None
+        """
         table = cls.__db__[cls.__tablename__]
-        sql = select([func.count('*')], from_obj=table)
+        if cls.__modified_column__ is None or cls.__modified_column__ not in table.c:
+            return None
+        if query is None:
+            query = {}
+        query = cls.reformatter(query, *args, **kwargs)
+        columns = [func.count(), func.max(table.c[cls.__modified_column__])]
+        if 'id' in table.c:
+            columns.append(func.max(table.c.id))
+        sql = select(columns).select_from(table)
         if query:
             sql = search_sql(sql, query, table)
+        res = await cls.__db__.execute(ctx=ctx, sql=sql)
+        row = await res.first()
+        return tuple(row)
 
+    @classmethod
+    async def aggregate(cls, ctx: dict = None, query: dict = None, group_by: list = None, metrics: list = None, *args,
+                        **kwargs):
+        """
+        分组聚合
+        :param ctx:
+        :param query: 过滤条件 与 query 相同
+        :param group_by: 分组的列
+        :param metrics: 聚合指标 形如 count:* sum:amount avg:score
+        :return: [{分组列..., count_all: 10, sum_amount: 20.5}]
+        """
+        if query is None:
+            query = {}
+        query = cls.reformatter(query, *args, **kwargs)
+        table = cls.__db__[cls.__tablename__]
+        group_columns = [table.c[name] for name in group_by or []]
+        metric_columns = []
+        for metric in metrics or ['count:*']:
+            name, column, label = parse_metric(metric)
+            if column == '*':
+                metric_columns.append(func.count().label(label))
+            else:
+                metric_columns.append(getattr(func, name)(table.c[column]).label(label))
+        sql = select(group_columns + metric_columns).select_from(table)
+        if query:
+            sql = search_sql(sql, query, table)
+        if group_columns:
+            sql = sql.group_by(*group_columns)
         res = await cls.__db__.execute(ctx=ctx, sql=sql)
-        return await res.scalar()
+        data = await res.fetchall()
+        return list(map(type_to_json, data))
 
     @classmethod
     async def execute(cls, ctx: dict = None, sql: str = ""):
@@ -246,12 +567,47 @@ class BaseDao(metaclass=DaoMetaClass):
         return res
 
     @classmethod
-    async def update(cls, ctx: dict = None, where_dict: dict = None, data: dict = None, *args, **kwargs):
+    def _version_values(cls, table, data: dict) -> (dict, object):
+        """
+        设置 __version_column__ 时 修改的数据中的版本号作为期望的版本 写入时版本号加一
+        :param table:
+        :param data:
+        :return: (写入的数据, 期望的版本 数据中没有版本号时为 None)
+        """
+        if cls.__version_column__ is None:
+            return data, None
+        values = dict(data)
+        expected = values.pop(cls.__version_column__, None)
+        column = table.c[cls.__version_column__]
+        values[cls.__version_column__] = column + 1
+        return values, expected
+
+    @classmethod
+    async def _check_conflict(cls, ctx: dict, table, where_dict: dict):
+        """
+        带版本号的修改没有修改到数据时 数据仍存在说明版本已经变化
+        :param ctx:
+        :param table:
+        :param where_dict:
+        :return:
+        """
+        sql = select([table.c.id])
+        for key, value in where_dict.items():
+            if hasattr(table.c, key):
+                sql = sql.where(getattr(table.c, key) == value)
+        res = await cls.__db__.execute(ctx=ctx, sql=sql.limit(1))
+        if await res.first() is not None:
+            raise ConflictError()
+
+    @classmethod
+    async def update(cls, ctx: dict = None, where_dict: dict = None, data: dict = None, *args,
+                     change_action: str = 'update', **kwargs):
         """
         通用修改
         :param ctx:
         :param primay_key:
         :param data:
+        :param change_action: 发布到 __change_bus__ 的事件类型
         :return:
         """
         if where_dict is None:
@@ -259,12 +615,20 @@ class BaseDao(metaclass=DaoMetaClass):
         where_dict = cls.reformatter(where_dict, *args, **kwargs)
         table = cls.__db__[cls.__tablename__]
         data = cls.reformatter(data, *args, **kwargs)
+        values, expected = cls._version_values(table, data)
         sql = table.update()
         for key, value in where_dict.items():
             if hasattr(table.c, key):
                 sql = sql.where(getattr(table.c, key) == value)
-        sql = sql.values(**data)
+        if expected is not None:
+            sql = sql.where(table.c[cls.__version_column__] == expected)
+        sql = sql.values(**values)
         res = await cls.__db__.execute(ctx=ctx, sql=sql)
+        if expected is not None:
+            if res.rowcount == 0:
+                await cls._check_conflict(ctx, table, where_dict)
+            data = dict(data, **{cls.__version_column__: expected + 1})
+        cls._publish(change_action, dict(where_dict, **data))
         return res
 
     @classmethod
@@ -285,10 +649,115 @@ class BaseDao(metaclass=DaoMetaClass):
             if hasattr(table.c, key):
                 sql = sql.where(getattr(table.c, key) == value)
         res = await cls.__db__.execute(ctx=ctx, sql=sql)
+        cls._publish('delete', where_dict)
         return res
 
+    @classmethod
+    def _publish(cls, action: str, data: dict):
+        """
+        向 __change_bus__ 发布变更 在事务中时会早于提交发布
+        :param action:
+        :param data:
+        :return:
+        """
+        if cls.__change_bus__ is not None:
+            cls.__change_bus__.publish(cls.__tablename__, action, data)
+
+    @classmethod
+    async def _count_where(cls, query: dict) -> int:
+        table = cls.__db__[cls.__tablename__]
+        sql = select([func.count()]).select_from(table)
+        if query:
+            sql = search_sql(sql, query, table)
+        res = await cls.__db__.execute(sql=sql)
+        return await res.scalar()
+
+    @classmethod
+    async def _execute_batches(cls, query: dict, build, batch_size: int, rate_limit: float, progress, *args,
+                               **kwargs) -> int:
+        """
+        按主键顺序分批执行 build(ids) 生成的 sql 每批一个短事务
+        :param query: 选出每批 id 的条件
+        :param build: build(ids) 返回本批执行的 sql
+        :param batch_size:
+        :param rate_limit: 每秒最多处理的行数
+        :param progress: 每批完成后调用 progress(已影响的行数)
+        :return: 影响的行数
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        scanned = 0
+        total = 0
+        async for ids in cls.id_batches(None, query, batch_size, None, *args, **kwargs):
+            async with get_tx(cls.__db__) as conn:
+                res = await cls.__db__.execute(ctx={'connection': conn}, sql=build(ids))
+            scanned += len(ids)
+            total += res.rowcount
+            if progress is not None:
+                progress(total)
+            if rate_limit:
+                wait = start + scanned / rate_limit - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+        return total
+
+    @classmethod
+    async def update_where(cls, query: dict, data: dict, batch_size: int = 1000, rate_limit: float = None,
+                           progress=None, dry_run: bool = False, *args, change_action: str = 'update', **kwargs) -> int:
+        """
+        按条件分批修改 条件与 query 相同 每批按主键顺序取 batch_size 行 在单独的短事务中修改
+        避免一条 update 长时间锁住大量数据 影响线上和从库
+        :param query:
+        :param data:
+        :param batch_size:
+        :param rate_limit: 每秒最多处理的行数
+        :param progress: 每批完成后调用 progress(已修改的行数)
+        :param dry_run: 只返回满足条件的行数 不修改
+        :param change_action: 发布到 __change_bus__ 的事件类型
+        :return: 修改的行数
+        """
+        table = cls.__db__[cls.__tablename__]
+        where = cls.reformatter(dict(query), *args, **kwargs)
+        if dry_run:
+            return await cls._count_where(where)
+        data = cls.reformatter(data, *args, **kwargs)
+        # 批量修改不检查版本 只将版本号加一
+        values, _ = cls._version_values(table, data)
+
+        def build(ids):
+            return search_sql(table.update().where(table.c.id.in_(ids)), where, table).values(**values)
+        total = await cls._execute_batches(dict(query), build, batch_size, rate_limit, progress, *args, **kwargs)
+        cls._publish(change_action, dict(where, **data))
+        return total
+
+    @classmethod
+    async def delete_where(cls, query: dict, batch_size: int = 1000, rate_limit: float = None, progress=None,
+                           dry_run: bool = False, *args, **kwargs) -> int:
+        """
+        按条件分批删除 与 update_where 相同
+        :param query:
+        :param batch_size:
+        :param rate_limit: 每秒最多处理的行数
+        :param progress: 每批完成后调用 progress(已删除的行数)
+        :param dry_run: 只返回满足条件的行数 不删除
+        :return: 删除的行数
+        """
+        table = cls.__db__[cls.__tablename__]
+        where = cls.reformatter(dict(query), *args, **kwargs)
+        if dry_run:
+            return await cls._count_where(where)
+
+        def build(ids):
+            return search_sql(table.delete().where(table.c.id.in_(ids)), where, table)
+        total = await cls._execute_batches(dict(query), build, batch_size, rate_limit, progress, *args, **kwargs)
+        cls._publish('delete', where)
+        return total
+
 
 class BusinessBaseDao(BaseDao):
+    __modified_column__ = 'updated_at'
+    # unscoped 查询时是否包含 archive 移走的数据
+    __archive__ = False
 
     @classmethod
     def formatter(cls, data: dict, *args, **kwargs):
@@ -341,9 +810,11 @@ class BusinessBaseDao(BaseDao):
         if where_dict is None:
             where_dict = {}
         data = dict()
-        data['deleted_at'] = datetime.datetime.now()
+        # 同时修改 updated_at 删除后 version 和 ETag 随之变化
+        data['deleted_at'] = data['updated_at'] = datetime.datetime.now()
         data['updated_by'] = modify_by
-        return await super().update(ctx=ctx, where_dict=where_dict, data=data, unscoped=unscoped)
+        return await super().update(ctx=ctx, where_dict=where_dict, data=data, unscoped=unscoped,
+                                    change_action='delete')
 
     @classmethod
     async def insert(cls, ctx: dict = None, data: dict = None, modify_by='', unscoped=False):
@@ -352,3 +823,138 @@ class BusinessBaseDao(BaseDao):
         data['created_at'] = datetime.datetime.now()
         data['created_by'] = modify_by
         return await super().insert(ctx=ctx, data=data, unscoped=unscoped)
+
+    @classmethod
+    async def insert_many(cls, data_list: list, ctx: dict = None, use_copy: bool = False, modify_by='',
+                          unscoped=False):
+        """
+        业务批量插入
+        :param data_list:
+        :param ctx:
+        :param use_copy:
+        :param modify_by:
+        :return:
+        """
+        now = datetime.datetime.now()
+        for data in data_list:
+            data['created_at'] = now
+            data['created_by'] = modify_by
+        return await super().insert_many(data_list=data_list, ctx=ctx, use_copy=use_copy, unscoped=unscoped)
+
+    @classmethod
+    async def update_where(cls, query: dict, data: dict, batch_size: int = 1000, rate_limit: float = None,
+                           progress=None, dry_run: bool = False, unscoped=False, modify_by: str = '') -> int:
+        """
+        业务分批修改
+        :param query:
+        :param data:
+        :param batch_size:
+        :param rate_limit:
+        :param progress:
+        :param dry_run:
+        :param unscoped:
+        :param modify_by:
+        :return:
+        """
+        data = dict(data, updated_at=datetime.datetime.now(), updated_by=modify_by)
+        return await super().update_where(query=query, data=data, batch_size=batch_size, rate_limit=rate_limit,
+                                          progress=progress, dry_run=dry_run, unscoped=unscoped)
+
+    @classmethod
+    async def delete_where(cls, query: dict, batch_size: int = 1000, rate_limit: float = None, progress=None,
+                           dry_run: bool = False, unscoped=False, modify_by: str = '') -> int:
+        """
+        业务分批删除 只设置 deleted_at
+        :param query:
+        :param batch_size:
+        :param rate_limit:
+        :param progress:
+        :param dry_run:
+        :param unscoped:
+        :param modify_by:
+        :return:
+        """
+        now = datetime.datetime.now()
+        data = {'deleted_at': now, 'updated_at': now, 'updated_by': modify_by}
+        return await super().update_where(query=query, data=data, batch_size=batch_size, rate_limit=rate_limit,
+                                          progress=progress, dry_run=dry_run, unscoped=unscoped,
+                                          change_action='delete')
+
+    @classmethod
+    def archive_name(cls) -> str:
+        return cls.__tablename__ + '_archive'
+
+    @classmethod
+    async def archive_table(cls, create: bool = False):
+        """
+        归档表 与原表的列相同
+        :param create: 不存在时是否创建
+        :return: 不存在且不创建时返回 None
+        """
+        metadata = cls.__db__._metadata
+        name = cls.archive_name()
+        if name in metadata.tables:
+            return metadata.tables[name]
+        if not create:
+            return None
+        table = cls.__db__[cls.__tablename__]
+        archive = Table(name, metadata, *[Column(column.name, column.type, primary_key=column.primary_key,
+                                                 autoincrement=False, nullable=column.nullable)
+                                          for column in table.columns])
+        try:
+            await cls.__db__.execute(sql=CreateTable(archive))
+        except Exception as e:
+            # 其他进程已经创建
+            if 'exist' not in str(e).lower():
+                metadata.remove(archive)
+                raise
+        return archive
+
+    @classmethod
+    def _read_table(cls, *args, **kwargs):
+        """
+        设置 __archive__ 后 unscoped 查询同时查询归档表
+        :return:
+        """
+        table = cls.__db__[cls.__tablename__]
+        if not cls.__archive__ or not kwargs.get('unscoped', False):
+            return table
+        archive = cls.__db__._metadata.tables.get(cls.archive_name())
+        if archive is None:
+            return table
+        # 按原表的列对齐 归档表缺少的列补 NULL
+        archive_columns = [archive.c[column.name] if column.name in archive.c else null().label(column.name)
+                           for column in table.columns]
+        return union_all(select([table]), select(archive_columns)).alias(table.name + '_all')
+
+    @classmethod
+    async def archive(cls, days: int = 30, batch_size: int = 1000, sleep: float = 0.1, purge: bool = False,
+                      progress=None) -> int:
+        """
+        将 deleted_at 早于 days 天前的数据按主键顺序分批移到归档表 <table>_archive
+        每批在单独的短事务中先写入归档表再删除 中断后重新执行即可继续
+        :param days:
+        :param batch_size: 每批的行数
+        :param sleep: 每批之间等待的秒数 减小对线上和从库的压力
+        :param purge: 为 True 时直接删除 不写入归档表
+        :param progress: 每批完成后调用 progress(已处理的行数)
+        :return: 处理的行数
+        """
+        table = cls.__db__[cls.__tablename__]
+        archive = None if purge else await cls.archive_table(create=True)
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+        total = 0
+        async for ids in cls.id_batches(query={'_lt_deleted_at': cutoff}, batch_size=batch_size, unscoped=True):
+            condition = and_(table.c.id.in_(ids), table.c.deleted_at < cutoff)
+            async with get_tx(cls.__db__) as conn:
+                ctx = {'connection': conn}
+                if archive is not None:
+                    await cls.__db__.execute(ctx=ctx, sql=archive.insert().from_select(
+                        [column.name for column in table.columns], select([table]).where(condition)))
+                res = await cls.__db__.execute(ctx=ctx, sql=table.delete().where(condition))
+            total += res.rowcount
+            if progress is not None:
+                progress(total)
+            if sleep:
+                await asyncio.sleep(sleep)
+        return total
@@ -1,6 +1,12 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
 from sqlalchemy import MetaData
 import sqlalchemy as sa
-from aiomysql.sa import create_engine
+from sqlalchemy.sql import Select, Insert
+from sqlalchemy.dialects.sqlite import pysqlite
+from sqlalchemy.dialects.postgresql.base import PGDialect, PGCompiler
 
 
 def get_sync_engine(user: str, password: str, host: str, port: str, database: str):
@@ -23,7 +29,7 @@ def get_sync_engine(user: str, password: str, host: str, port: str, database: st
     return engine
 
 
-async def get_engine(user: str, password: str, host: str, port: str, database: str):
+async def get_engine(user: str, password: str, host: str, port: str, database: str, pool_size=10):
     print('mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4'.format(
         user=user,
         password=password,
@@ -31,12 +37,14 @@ async def get_engine(user: str, password: str, host: str, port: str, database: s
         port=port,
         database=database,
     ))
+    from aiomysql.sa import create_engine
     engine = await create_engine(
         user=user,
         password=password,
         host=host,  # your host
         port=port,
         db=database,
+        maxsize=pool_size,
         autocommit=True
     )
     return engine
@@ -47,30 +55,39 @@ class MysqlDB(object):
     用于操作 mysql 的db对象
     """
 
-    def __init__(self, user, password, host, port, database):
+    def __init__(self, user, password, host, port, database, pool_size=10):
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.database = database
+        self.pool_size = pool_size
         self._engine = None
         self._sync_engine = None
         self._metadata = None
         self._tables = None
 
-    async def connect(self):
+    def reflect(self):
         """
-        链接数据库 初始化engine
+        同步读取表结构 已读取过时 connect 不再重复读取
         :return:
         """
         self._sync_engine = get_sync_engine(user=self.user, password=self.password, host=self.host, port=self.port,
                                             database=self.database)
-        self._engine = await get_engine(user=self.user, password=self.password, host=self.host, port=self.port,
-                                        database=self.database)
         self._metadata = MetaData(self._sync_engine)
         self._metadata.reflect(bind=self._sync_engine)
         self._tables = self._metadata.tables
 
+    async def connect(self):
+        """
+        链接数据库 初始化engine
+        :return:
+        """
+        if self._tables is None:
+            self.reflect()
+        self._engine = await get_engine(user=self.user, password=self.password, host=self.host, port=self.port,
+                                        database=self.database, pool_size=self.pool_size)
+
     def __getitem__(self, name):
         return self._tables[name]
 
@@ -94,3 +111,742 @@ class MysqlDB(object):
                 return await conn.execute(sql, *args, **kwargs)
         else:
             return await conn.execute(sql, *args, **kwargs)
+
+
+# 当前请求的租户 通常在 before_request 中设置: current_tenant.set(request.headers['X-Tenant'])
+current_tenant = contextvars.ContextVar('current_tenant', default=None)
+
+
+class TenantAcquireContext(object):
+    """
+    与 aiomysql 的 engine.acquire() 相同 可以 await 也可以 async with
+    """
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._conn = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        self._conn = await self._coro
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._conn.close()
+        self._conn = None
+
+
+class TenantEngine(object):
+    """
+    TenantMysqlDB 的 _engine 按当前租户从对应的连接池获取连接
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def acquire(self) -> TenantAcquireContext:
+        return TenantAcquireContext(self._db.acquire())
+
+
+class TenantMysqlDB(MysqlDB):
+    """
+    每个租户一个数据库 按 current_tenant 选择数据库
+    连接池在租户第一次访问时创建 超过 max_pools 或空闲超过 idle_timeout 的连接池按 LRU 关闭
+    结构相同的租户共用一份反射的表结构 (默认所有租户相同 从 template 租户的数据库读取)
+    用法:
+        db = TenantMysqlDB('root', 'pwd', 'localhost', 3306, database='app_{tenant}', template='demo')
+    """
+
+    def __init__(self, user, password, host, port, database: str = '{tenant}', template=None, pool_size=10,
+                 max_pools: int = 20, idle_timeout: float = 300, schema_of=None, resolver=None):
+        """
+        :param database: 数据库名 {tenant} 会被替换为租户
+        :param template: 用于读取表结构的租户
+        :param pool_size: 每个租户的连接数
+        :param max_pools: 最多同时打开的连接池数 总连接数不超过 max_pools * pool_size
+        :param idle_timeout: 连接池空闲多少秒后关闭
+        :param schema_of: schema_of(tenant) 返回表结构的分组 同一组的租户共用表结构 默认所有租户为一组
+        :param resolver: resolver(tenant) 返回该租户的连接参数 (user password host port database) 覆盖默认值
+        """
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.database = database
+        self.template = template
+        self.pool_size = pool_size
+        self.max_pools = max_pools
+        self.idle_timeout = idle_timeout
+        self.schema_of = schema_of
+        self.resolver = resolver
+        self._sync_engine = None
+        self._metadata = None
+        self._tables = None
+        # 表结构分组 -> (metadata, tables)
+        self._schemas = {}
+        # 租户 -> [engine, 最后使用时间] 按使用顺序排列
+        self._pools = OrderedDict()
+        self._opening = {}
+        self._last_sweep = time.monotonic()
+
+    @property
+    def _engine(self) -> TenantEngine:
+        return TenantEngine(self)
+
+    def params(self, tenant) -> dict:
+        """
+        租户的连接参数
+        :param tenant:
+        :return:
+        """
+        params = dict(user=self.user, password=self.password, host=self.host, port=self.port,
+                      database=self.database.format(tenant=tenant))
+        if self.resolver is not None:
+            params.update(self.resolver(tenant))
+        return params
+
+    def tenant(self):
+        tenant = current_tenant.get()
+        if tenant is None:
+            raise RuntimeError('current_tenant is not set')
+        return tenant
+
+    def reflect(self, tenant=None):
+        """
+        同步读取表结构 tenant 为 None 时读取 template 租户 作为默认的表结构
+        :param tenant:
+        :return:
+        """
+        tenant = self.template if tenant is None else tenant
+        params = self.params(tenant)
+        engine = get_sync_engine(**params)
+        metadata = MetaData(engine)
+        metadata.reflect(bind=engine)
+        key = self.schema_of(tenant) if self.schema_of is not None else None
+        self._schemas[key] = (metadata, metadata.tables)
+        if self._tables is None:
+            self._sync_engine, self._metadata, self._tables = engine, metadata, metadata.tables
+        else:
+            engine.dispose()
+        return metadata.tables
+
+    async def connect(self):
+        """
+        只读取表结构 连接池在租户第一次访问时创建
+        :return:
+        """
+        if self._tables is None:
+            self.reflect()
+
+    def _schema(self):
+        if self.schema_of is None:
+            return self._tables
+        tenant = self.tenant()
+        key = self.schema_of(tenant)
+        schema = self._schemas.get(key)
+        if schema is None:
+            # 新的表结构分组第一次访问 同步读取一次
+            return self.reflect(tenant)
+        return schema[1]
+
+    def __getitem__(self, name):
+        return self._schema()[name]
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._schema()[item]
+
+    async def pool(self, tenant=None):
+        """
+        租户的连接池 不存在时创建
+        :param tenant: 默认为当前租户
+        :return:
+        """
+        if tenant is None:
+            tenant = self.tenant()
+        now = time.monotonic()
+        entry = self._pools.get(tenant)
+        if entry is not None:
+            entry[1] = now
+            self._pools.move_to_end(tenant)
+            if now - self._last_sweep > self.idle_timeout / 2:
+                await self.evict(now, keep=tenant)
+            return entry[0]
+        # 同一个租户同时只创建一个连接池
+        opening = self._opening.get(tenant)
+        if opening is None:
+            opening = self._opening[tenant] = asyncio.ensure_future(self._open(tenant))
+            opening.add_done_callback(lambda _: self._opening.pop(tenant, None))
+        return await asyncio.shield(opening)
+
+    async def _open(self, tenant):
+        engine = await get_engine(pool_size=self.pool_size, **self.params(tenant))
+        self._pools[tenant] = [engine, time.monotonic()]
+        await self.evict(keep=tenant)
+        return engine
+
+    async def evict(self, now: float = None, keep=None) -> int:
+        """
+        关闭空闲超时的连接池 连接池数超过 max_pools 时按最久未使用的顺序关闭没有连接在使用的连接池
+        :param now:
+        :param keep: 正在使用的租户 不关闭
+        :return: 关闭的连接池数
+        """
+        now = time.monotonic() if now is None else now
+        self._last_sweep = now
+        closing = []
+        over = len(self._pools) - self.max_pools
+        for tenant, (engine, last_used) in list(self._pools.items()):
+            if tenant == keep or engine.freesize != engine.size:
+                continue
+            if over > 0 or now - last_used > self.idle_timeout:
+                closing.append(engine)
+                del self._pools[tenant]
+                over -= 1
+        for engine in closing:
+            engine.close()
+            await engine.wait_closed()
+        return len(closing)
+
+    async def acquire(self):
+        engine = await self.pool()
+        return await engine.acquire()
+
+    async def close(self):
+        """
+        关闭所有租户的连接池
+        :return:
+        """
+        pools, self._pools = self._pools, OrderedDict()
+        for engine, _ in pools.values():
+            engine.close()
+            await engine.wait_closed()
+
+
+def get_sync_sqlite_engine(path: str):
+    print('sqlite:///{path}'.format(path=path))
+    engine = sa.create_engine('sqlite:///{path}'.format(path=path))
+    return engine
+
+
+def is_read_sql(sql):
+    """
+    判断sql是否为只读查询 用于读写分离
+    :param sql:
+    :return:
+    """
+    if isinstance(sql, Select):
+        return True
+    if isinstance(sql, str):
+        return sql.lstrip().lower().startswith(('select', 'with', 'pragma', 'explain'))
+    return False
+
+
+def compile_sql(sql, dialect, *args, **kwargs):
+    """
+    将sqlalchemy语句编译成 (sql字符串, 位置参数, 结果处理函数)
+    :param sql:
+    :param dialect:
+    :return:
+    """
+    if isinstance(sql, str):
+        return sql, list(args), None
+    compiled = sql.compile(dialect=dialect)
+    if not hasattr(compiled, 'positiontup'):
+        # DDL
+        return str(compiled), [], None
+    params = compiled.construct_params(kwargs or None)
+    processors = compiled._bind_processors
+    values = []
+    for name in compiled.positiontup:
+        value = params[name]
+        if name in processors:
+            value = processors[name](value)
+        values.append(value)
+    result_processors = [column[3].result_processor(dialect, None) for column in compiled._result_columns]
+    return str(compiled), values, result_processors
+
+
+class BufferedRow(tuple):
+    """
+    兼容 RowProxy 的行对象 支持下标 列名 和 items()
+    """
+
+    def __new__(cls, keys, values):
+        row = tuple.__new__(cls, values)
+        row._keys = keys
+        return row
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            try:
+                item = self._keys.index(item)
+            except ValueError:
+                raise KeyError(item)
+        return tuple.__getitem__(self, item)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def get(self, key, default=None):
+        if key in self._keys:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return list(zip(self._keys, self))
+
+
+class BufferedResultProxy(object):
+    """
+    已取回全部数据的结果集 接口与 aiomysql.sa 的 ResultProxy 一致
+    """
+
+    def __init__(self, rows=None, lastrowid=None, rowcount=-1):
+        self._rows = list(rows or [])
+        self._index = 0
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    async def fetchone(self):
+        if self._index >= len(self._rows):
+            return None
+        row = self._rows[self._index]
+        self._index += 1
+        return row
+
+    async def fetchmany(self, size=None):
+        size = size or 1
+        rows = self._rows[self._index:self._index + size]
+        self._index += len(rows)
+        return rows
+
+    async def fetchall(self):
+        rows = self._rows[self._index:]
+        self._index = len(self._rows)
+        return rows
+
+    async def first(self):
+        if not self._rows:
+            return None
+        return self._rows[0]
+
+    async def scalar(self):
+        row = await self.first()
+        if row is None:
+            return None
+        return row[0]
+
+
+class SqliteTransaction(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def commit(self):
+        await self._conn.execute('COMMIT')
+
+    async def rollback(self):
+        await self._conn.execute('ROLLBACK')
+
+
+class SqliteConnection(object):
+    """
+    aiosqlite 连接的包装 提供与 aiomysql.sa 连接一致的 execute/begin/close
+    """
+
+    def __init__(self, conn, dialect, release=None):
+        self._conn = conn
+        self._dialect = dialect
+        self._release = release
+
+    async def execute(self, sql, *args, **kwargs):
+        sql, params, processors = compile_sql(sql, self._dialect, *args, **kwargs)
+        cursor = await self._conn.execute(sql, params)
+        try:
+            rows = []
+            if cursor.description:
+                keys = [column[0] for column in cursor.description]
+                if not processors or len(processors) != len(keys):
+                    processors = [None] * len(keys)
+                for row in await cursor.fetchall():
+                    rows.append(BufferedRow(keys, [
+                        processor(value) if processor else value for processor, value in zip(processors, row)
+                    ]))
+            return BufferedResultProxy(rows=rows, lastrowid=cursor.lastrowid, rowcount=cursor.rowcount)
+        finally:
+            await cursor.close()
+
+    async def begin(self):
+        await self._conn.execute('BEGIN IMMEDIATE')
+        return SqliteTransaction(self._conn)
+
+    async def close(self):
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+
+class SqliteEngine(object):
+    """
+    一个串行的写连接 + 读连接池
+    """
+
+    def __init__(self, writer, readers, dialect):
+        self._writer = writer
+        self._readers = asyncio.Queue()
+        self._all_readers = readers
+        self._dialect = dialect
+        self._lock = asyncio.Lock()
+        for reader in readers:
+            self._readers.put_nowait(reader)
+
+    async def acquire(self):
+        """
+        获取写连接 在 close 之前其他写入需要等待
+        :return:
+        """
+        await self._lock.acquire()
+        return SqliteConnection(self._writer, self._dialect, release=self._lock.release)
+
+    async def acquire_reader(self):
+        reader = await self._readers.get()
+        return SqliteConnection(reader, self._dialect, release=lambda: self._readers.put_nowait(reader))
+
+    async def close(self):
+        for conn in [self._writer] + self._all_readers:
+            await conn.close()
+
+
+class SqliteDB(object):
+    """
+    用于操作 sqlite 的db对象 基于 aiosqlite
+    """
+
+    def __init__(self, path, pool_size=5, wal=True):
+        self.path = path
+        self.pool_size = pool_size
+        self.wal = wal
+        self._engine = None
+        self._sync_engine = None
+        self._metadata = None
+        self._tables = None
+
+    async def _open(self):
+        import aiosqlite
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        if self.wal:
+            await conn.execute('PRAGMA journal_mode=WAL')
+            await conn.execute('PRAGMA synchronous=NORMAL')
+        await conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def reflect(self):
+        """
+        同步读取表结构 已读取过时 connect 不再重复读取
+        :return:
+        """
+        self._sync_engine = get_sync_sqlite_engine(path=self.path)
+        self._metadata = MetaData(self._sync_engine)
+        self._metadata.reflect(bind=self._sync_engine)
+        self._tables = self._metadata.tables
+
+    async def connect(self):
+        """
+        链接数据库 初始化engine
+        :return:
+        """
+        if self._tables is None:
+            self.reflect()
+        writer = await self._open()
+        readers = [await self._open() for _ in range(self.pool_size)]
+        self._engine = SqliteEngine(writer, readers, pysqlite.dialect())
+
+    async def close(self):
+        """
+        关闭所有连接
+        :return:
+        """
+        if self._engine is not None:
+            await self._engine.close()
+            self._engine = None
+
+    def __getitem__(self, name):
+        return self._tables[name]
+
+    def __getattr__(self, item):
+        return self._tables[item]
+
+    async def execute(self, sql, ctx: dict = None, *args, **kwargs, ):
+        """
+        执行sql 只读查询走读连接池 其余走写连接
+        :param ctx:
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        conn = None
+        if ctx is not None:
+            conn = ctx.get("connection", None)
+        if conn is not None:
+            return await conn.execute(sql, *args, **kwargs)
+        if is_read_sql(sql):
+            conn = await self._engine.acquire_reader()
+        else:
+            conn = await self._engine.acquire()
+        try:
+            return await conn.execute(sql, *args, **kwargs)
+        finally:
+            await conn.close()
+
+
+def get_sync_postgre_engine(user: str, password: str, host: str, port: str, database: str):
+    print('postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}'.format(
+        user=user,
+        password=password,
+        host=host,  # your host
+        port=port,
+        database=database,
+    ))
+    engine = sa.create_engine(
+        'postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}'.format(
+            user=user,
+            password=password,
+            host=host,  # your host
+            port=port,
+            database=database
+        ),
+    )
+    return engine
+
+
+async def get_postgre_pool(user: str, password: str, host: str, port: str, database: str, pool_size=10,
+                           statement_cache_size=1024):
+    import asyncpg
+    print('postgresql://{user}:{password}@{host}:{port}/{database}'.format(
+        user=user,
+        password=password,
+        host=host,  # your host
+        port=port,
+        database=database,
+    ))
+    pool = await asyncpg.create_pool(
+        user=user,
+        password=password,
+        host=host,
+        port=port,
+        database=database,
+        min_size=1,
+        max_size=pool_size,
+        statement_cache_size=statement_cache_size,
+    )
+    return pool
+
+
+class AsyncpgCompiler(PGCompiler):
+    """
+    asyncpg 使用 $1 $2 ... 形式的占位符
+    """
+
+    def bindparam_string(self, name, **kw):
+        return '$' + super().bindparam_string(name, **kw)[1:]
+
+
+class AsyncpgDialect(PGDialect):
+    statement_compiler = AsyncpgCompiler
+    default_paramstyle = 'numeric'
+    implicit_returning = True
+
+
+class PostgreTransaction(object):
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    async def commit(self):
+        await self._transaction.commit()
+
+    async def rollback(self):
+        await self._transaction.rollback()
+
+
+class PostgreConnection(object):
+    """
+    asyncpg 连接的包装 提供与 aiomysql.sa 连接一致的 execute/begin/close
+    insert 会自动追加 RETURNING id 并作为 lastrowid 返回
+    """
+
+    def __init__(self, conn, dialect, release=None):
+        self._conn = conn
+        self._dialect = dialect
+        self._release = release
+
+    async def execute(self, sql, *args, **kwargs):
+        if isinstance(sql, Insert) and sql._returning is None and 'id' in sql.table.c:
+            sql = sql.returning(sql.table.c.id)
+        returning = getattr(sql, '_returning', None) is not None
+        sql, params, _ = compile_sql(sql, self._dialect, *args, **kwargs)
+        if returning or is_read_sql(sql):
+            # fetch/execute 均会复用 asyncpg 的 prepared statement 缓存
+            rows = await self._conn.fetch(sql, *params)
+            lastrowid = rows[0][0] if returning and rows else None
+            return BufferedResultProxy(rows=rows, lastrowid=lastrowid, rowcount=len(rows))
+        status = await self._conn.execute(sql, *params)
+        rowcount = -1
+        if status and status.split()[-1].isdigit():
+            rowcount = int(status.split()[-1])
+        return BufferedResultProxy(rowcount=rowcount)
+
+    async def copy_records(self, table, columns, records):
+        """
+        使用 COPY 批量写入
+        :param table:
+        :param columns:
+        :param records:
+        :return:
+        """
+        status = await self._conn.copy_records_to_table(table.name, records=records, columns=columns,
+                                                        schema_name=table.schema)
+        return int(status.split()[-1])
+
+    async def begin(self):
+        transaction = self._conn.transaction()
+        await transaction.start()
+        return PostgreTransaction(transaction)
+
+    async def close(self):
+        if self._release is not None:
+            await self._release(self._conn)
+            self._release = None
+
+
+class PostgreEngine(object):
+    def __init__(self, pool, dialect):
+        self._pool = pool
+        self._dialect = dialect
+
+    async def acquire(self):
+        conn = await self._pool.acquire()
+        return PostgreConnection(conn, self._dialect, release=self._pool.release)
+
+    async def close(self):
+        await self._pool.close()
+
+
+class PostgreDB(object):
+    """
+    用于操作 postgredb 的db对象 基于 asyncpg
+    """
+
+    def __init__(self, user, password, host, port, database, pool_size=10, statement_cache_size=1024):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.database = database
+        self.pool_size = pool_size
+        self.statement_cache_size = statement_cache_size
+        self._engine = None
+        self._sync_engine = None
+        self._metadata = None
+        self._tables = None
+
+    def reflect(self):
+        """
+        同步读取表结构 已读取过时 connect 不再重复读取
+        :return:
+        """
+        self._sync_engine = get_sync_postgre_engine(user=self.user, password=self.password, host=self.host,
+                                                    port=self.port, database=self.database)
+        self._metadata = MetaData(self._sync_engine)
+        self._metadata.reflect(bind=self._sync_engine)
+        self._tables = self._metadata.tables
+
+    async def connect(self):
+        """
+        链接数据库 初始化engine
+        :return:
+        """
+        if self._tables is None:
+            self.reflect()
+        pool = await get_postgre_pool(user=self.user, password=self.password, host=self.host, port=self.port,
+                                      database=self.database, pool_size=self.pool_size,
+                                      statement_cache_size=self.statement_cache_size)
+        self._engine = PostgreEngine(pool, AsyncpgDialect())
+
+    async def close(self):
+        """
+        关闭连接池
+        :return:
+        """
+        if self._engine is not None:
+            await self._engine.close()
+            self._engine = None
+
+    def __getitem__(self, name):
+        return self._tables[name]
+
+    def __getattr__(self, item):
+        return self._tables[item]
+
+    async def execute(self, sql, ctx: dict = None, *args, **kwargs, ):
+        """
+        执行sql
+        :param ctx:
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        conn = None
+        if ctx is not None:
+            conn = ctx.get("connection", None)
+        if conn is not None:
+            return await conn.execute(sql, *args, **kwargs)
+        conn = await self._engine.acquire()
+        try:
+            return await conn.execute(sql, *args, **kwargs)
+        finally:
+            await conn.close()
+
+    async def copy_records(self, table, columns, records, ctx: dict = None):
+        """
+        使用 COPY 协议批量写入
+        :param table:
+        :param columns:
+        :param records:
+        :param ctx:
+        :return: 写入行数
+        """
+        conn = None
+        if ctx is not None:
+            conn = ctx.get("connection", None)
+        if conn is not None:
+            return await conn.copy_records(table, columns, records)
+        conn = await self._engine.acquire()
+        try:
+            return await conn.copy_records(table, columns, records)
+        finally:
+            await conn.close()
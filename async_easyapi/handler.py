@@ -1,10 +1,14 @@
 import asyncio
 import functools
+import math
 import quart
 from quart import views
 import datetime
-from easyapi_tools.util import str2hump, DefaultUrlCondition
+from easyapi_tools.util import str2hump, DefaultUrlCondition, QueryStringUrlCondition, make_etag, etag_matches
 from easyapi_tools.errors import BusinessError
+from .permission import normalize_permissions
+from .sync_adapter import SyncController
+from .ratelimit import QUERY, WRITE, EXPORT, READ, default_limiter, normalize_rate_limits
 
 
 class QuartHandlerMeta(views.MethodViewType):
@@ -22,22 +26,170 @@ class QuartHandlerMeta(views.MethodViewType):
 
         attrs['__resource__'] = attrs.get('__resource__') or str2hump(name[:-7])
         attrs['__url_condition__'] = attrs.get('__url_condition__') or DefaultUrlCondition
+        if '__permissions__' in attrs:
+            attrs['__permissions__'] = normalize_permissions(attrs['__permissions__'])
+        if '__rate_limits__' in attrs:
+            attrs['__rate_limits__'] = normalize_rate_limits(attrs['__rate_limits__'])
         if not attrs.get('__controller__'):
             raise NotImplementedError("Handler require a  controller.")
+        if not asyncio.iscoroutinefunction(getattr(attrs['__controller__'], 'get', None)):
+            # 同步的 easyapi controller 放到线程池中运行
+            attrs['__controller__'] = SyncController(attrs['__controller__'])
 
         return type.__new__(cls, name, bases, attrs)
 
 
 class QuartBaseHandler(views.MethodView, metaclass=QuartHandlerMeta):
+    # GET 请求的 url 参数解析
+    __query_condition__ = QueryStringUrlCondition
+    # GET 响应的缓存头 为 None 时不设置
+    __cache_control__ = 'no-cache'
+    __vary__ = ('Accept-Encoding', 'Authorization')
+    # 各个方法需要的权限 {'put': AdminPermission, 'delete': (RolePermission, 'admin'), '*': LoginPermission}
+    __permissions__ = {}
+    # 每个客户端的限流 {'query': '20/s', 'write': '5/s', 'export': '10/m', 'read': (50, 100)} 没有配置的类型不限流
+    __rate_limits__ = {}
+    # 令牌桶 多个 worker 共享时使用 SharedTokenBucketLimiter
+    __rate_limiter__ = default_limiter
 
-    async def get(self, id: int,  *args, **kwargs):
+    def __init__(self, rate_limits: dict = None):
         """
-        获取单个资源
+        :param rate_limits: register_api 传入的限流配置 覆盖 __rate_limits__
+        """
+        if rate_limits is not None:
+            self.__rate_limits__ = rate_limits
+
+    def client_key(self):
+        """
+        限流使用的客户端标识 默认为客户端地址
+        未验证的请求头可以任意伪造 重载时应返回验证后的用户标识
+        :return:
+        """
+        return getattr(quart.request, 'remote_addr', None)
+
+    async def request_kind(self, *args, **kwargs) -> str:
+        """
+        请求的类型 用于选择限流配置
+        :param args: 路由中的参数 有主键时为单个资源
+        :param kwargs:
+        :return: query write export read
+        """
+        method = quart.request.method
+        if method == 'GET':
+            return READ if args or kwargs else QUERY
+        if method == 'POST':
+            body = await quart.request.json
+            if isinstance(body, dict) and body.get('_method') == 'GET':
+                return QUERY
+            if isinstance(body, dict) and body.get('_method') == 'AGG':
+                return EXPORT
+        return WRITE
+
+    async def rate_limit(self, *args, **kwargs):
+        """
+        按客户端 资源和请求类型检查 __rate_limits__ 超过时返回 429 和 Retry-After
+        :return: 允许时返回 None
+        """
+        kind = await self.request_kind(*args, **kwargs)
+        limit = self.__rate_limits__.get(kind)
+        if limit is None:
+            return None
+        key = (self.client_key(), self.__resource__, kind)
+        retry_after = self.__rate_limiter__.acquire(key, *limit)
+        if not retry_after:
+            return None
+        return quart.jsonify(code=429, msg='too many requests'), 429, {
+            'Retry-After': str(max(1, math.ceil(retry_after)))}
+
+    async def dispatch_request(self, *args, **kwargs):
+        """
+        检查 __rate_limits__ 和 __permissions__ 后再分发到对应的方法
+        :return:
+        """
+        if self.__rate_limits__:
+            limited = await self.rate_limit(*args, **kwargs)
+            if limited is not None:
+                return limited
+        method = quart.request.method.lower()
+        for permission, permission_args in self.__permissions__.get(method, self.__permissions__.get('*', ())):
+            if not await permission.decide(*permission_args):
+                return await permission.reject()
+        return await super().dispatch_request(*args, **kwargs)
+
+    def cacheable(self, response, etag: str = None):
+        """
+        为 GET 响应设置 Cache-Control Vary 和 ETag
+        :param response:
+        :param etag:
+        :return:
+        """
+        if self.__cache_control__:
+            response.headers['Cache-Control'] = self.__cache_control__
+        if self.__vary__:
+            response.headers['Vary'] = ', '.join(self.__vary__)
+        if etag is not None:
+            response.headers['ETag'] = etag
+        return response
+
+    def not_modified(self, etag: str):
+        return self.cacheable(quart.Response('', status=304), etag)
+
+    @classmethod
+    def query_table(cls):
+        """
+        url 参数按列类型转换时使用的表 controller 没有 dao 时返回 None
+        :return:
+        """
+        dao = getattr(cls.__controller__, '__dao__', None)
+        if dao is None:
+            return None
+        return dao.__db__[dao.__tablename__]
+
+    async def resource_etag(self, query: dict, *parts):
+        """
+        根据数据版本生成 ETag 不需要查询和序列化数据
+        :param query:
+        :param parts: 影响结果的其他参数
+        :return: controller 不支持版本时返回 None
+        """
+        version = await self.__controller__.version(dict(query))
+        if version is None:
+            return None
+        return make_etag(self.__resource__, version, *parts)
+
+    async def check_if_match(self, id):
+        """
+        校验 If-Match 当前资源的 ETag 不匹配时返回 412
         :param id:
         :return:
         """
+        header = quart.request.headers.get('If-Match')
+        if not header:
+            return
+        version = await self.__controller__.version({'id': id})
+        if version is not None:
+            etag = make_etag(self.__resource__, version) if version[0] else None
+        else:
+            data = await self.__controller__.get(id=id)
+            etag = make_etag(self.__resource__, data) if data else None
+        if not etag_matches(header, etag):
+            raise BusinessError(code=412, http_code=412, err_info='resource has been modified')
+
+    async def get(self, id: int = None, *args, **kwargs):
+        """
+        获取单个资源 没有 id 时按 url 参数查询列表
+        If-None-Match 命中时返回 304
+        :param id:
+        :return:
+        """
+        if id is None:
+            return await self.get_list(*args, **kwargs)
+        if_none_match = quart.request.headers.get('If-None-Match')
         try:
-            data = await self.__controller__.get(id=id,  *args, **kwargs)
+            etag = await self.resource_etag({'id': id})
+            if etag_matches(if_none_match, etag):
+                return self.not_modified(etag)
+            data = await self.__controller__.get(id=id, *args, **kwargs)
         except BusinessError as e:
             return quart.jsonify(code=e.code, msg=e.err_info), e.http_code
         if not data:
@@ -45,19 +197,53 @@ class QuartBaseHandler(views.MethodView, metaclass=QuartHandlerMeta):
                 'msg': '',
                 'code': 404,
             }), 404
-        return quart.jsonify(**{
+        if etag is None:
+            etag = make_etag(self.__resource__, data)
+            if etag_matches(if_none_match, etag):
+                return self.not_modified(etag)
+        return self.cacheable(quart.jsonify(**{
             'msg': '',
             'code': 200,
             self.__resource__: data
-        })
+        }), etag)
+
+    async def get_list(self, *args, **kwargs):
+        """
+        GET 查询列表 条件从 url 参数中解析 响应可以被 http 缓存
+        If-None-Match 命中时返回 304 带 _include 时关联资源没有版本 按内容生成 ETag
+        :return:
+        """
+        if_none_match = quart.request.headers.get('If-None-Match')
+        try:
+            query, pager, sorter = self.__query_condition__.parser(quart.request.args, table=self.query_table())
+            etag = None
+            if '_include' not in query:
+                etag = await self.resource_etag(query, pager, sorter)
+                if etag_matches(if_none_match, etag):
+                    return self.not_modified(etag)
+            res, count = await self.__controller__.query(query=query, pager=pager, sorter=sorter, *args, **kwargs)
+        except BusinessError as e:
+            return quart.jsonify(code=e.code, msg=e.err_info), e.http_code
+        if etag is None:
+            etag = make_etag(self.__resource__, res, count)
+            if etag_matches(if_none_match, etag):
+                return self.not_modified(etag)
+        return self.cacheable(quart.jsonify(**{
+            'msg': '',
+            'code': 200,
+            self.__resource__ + 's': res,
+            'total': count
+        }), etag)
 
     async def put(self, id,  *args, **kwargs):
         """
         新增的路由
+        带 If-Match 时资源已被修改返回 412
         :return:
         """
         body = await quart.request.json
         try:
+            await self.check_if_match(id)
             await self.__controller__.update(id=id, data=body,  *args, **kwargs)
         except BusinessError as e:
             return quart.jsonify(code=e.code, msg=e.err_info), e.http_code
@@ -66,10 +252,12 @@ class QuartBaseHandler(views.MethodView, metaclass=QuartHandlerMeta):
     async def delete(self, id,  *args, **kwargs):
         """
         删除的路由
+        带 If-Match 时资源已被修改返回 412
         :param id:
         :return:
         """
         try:
+            await self.check_if_match(id)
             await self.__controller__.delete(id=id,  *args, **kwargs)
         except BusinessError as e:
             return quart.jsonify(code=e.code, msg=e.err_info), e.http_code
@@ -77,10 +265,18 @@ class QuartBaseHandler(views.MethodView, metaclass=QuartHandlerMeta):
 
     async def post(self,  *args, **kwargs):
         """
-        处理 查询和新增
+        处理 查询 聚合和新增
+        _method: GET 查询 AGG 聚合 其余为新增
+        body 为数组时批量新增
         :return:
         """
         body = await quart.request.json
+        if isinstance(body, list):
+            try:
+                count = await self.__controller__.insert_many(body, *args, **kwargs)
+            except BusinessError as e:
+                return quart.jsonify(code=e.code, msg=e.err_info), e.http_code
+            return quart.jsonify(code=200, msg='', count=count)
         method = body.get("_method") or "POST"
 
         if method == 'GET':
@@ -96,6 +292,18 @@ class QuartBaseHandler(views.MethodView, metaclass=QuartHandlerMeta):
                 self.__resource__ + 's': res,
                 'total': count
             })
+        elif method == 'AGG':
+            query, _, _ = self.__url_condition__.parser(body.get("_args"))
+            try:
+                res = await self.__controller__.aggregate(query=query, group_by=body.get("_group_by"),
+                                                          metrics=body.get("_metrics"), *args, **kwargs)
+            except BusinessError as e:
+                return quart.jsonify(code=e.code, msg=e.err_info), e.http_code
+            return quart.jsonify(**{
+                'msg': '',
+                'code': 200,
+                'aggregations': res
+            })
         else:
             if '_method' in body:
                 del body['_method']
@@ -106,7 +314,42 @@ class QuartBaseHandler(views.MethodView, metaclass=QuartHandlerMeta):
             return quart.jsonify(code=200, msg='')
 
 
-def register_api(app, view, endpoint: str, url: str, pk='id', pk_type='int'):
+def subscribe_view(view, keepalive: float = 15):
+    """
+    生成一个 SSE 路由 推送 dao 的变更事件
+    过滤条件从 url 参数中解析 与列表查询一致
+    :param view: 视图类 dao 需要设置 __change_bus__
+    :param keepalive: 心跳间隔 秒
+    :return:
+    """
+    controller = view.__controller__
+    dao = controller.__dao__
+    if getattr(dao, '__change_bus__', None) is None:
+        raise NotImplementedError("Subscribe require dao with __change_bus__.")
+
+    async def subscribe(*args, **kwargs):
+        query, _, _ = view.__query_condition__.parser(quart.request.args, table=view.query_table())
+        query.pop('_include', None)
+        query = controller.reformatter(data=query)
+        subscription = dao.__change_bus__.subscribe(dao.__tablename__, query)
+
+        async def stream():
+            try:
+                while True:
+                    payload = await subscription.get(timeout=keepalive)
+                    if payload is None:
+                        yield b': keepalive\n\n'
+                    else:
+                        yield ('data: ' + payload + '\n\n').encode()
+            finally:
+                subscription.close()
+
+        return quart.Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    return subscribe
+
+
+def register_api(app, view, endpoint: str, url: str, pk='id', pk_type='int', subscribe=False, rate_limits=None):
     """
     将一个handler类的路由注册到app里
     :param app: 注册的app
@@ -115,11 +358,19 @@ def register_api(app, view, endpoint: str, url: str, pk='id', pk_type='int'):
     :param url: 链接
     :param pk: 主键
     :param pk_type: 类型
+    :param subscribe: 是否挂载 <url>/_subscribe 的 SSE 变更推送
+    :param rate_limits: 这组路由的限流配置 与 __rate_limits__ 格式相同
     :return:
     """
-    view_func = view.as_view(endpoint)
+    if rate_limits is not None:
+        view_func = view.as_view(endpoint, rate_limits=normalize_rate_limits(rate_limits))
+    else:
+        view_func = view.as_view(endpoint)
     app.add_url_rule(url,
                      view_func=view_func, methods=['GET', ])
     app.add_url_rule(url, view_func=view_func, methods=['POST', ])
     app.add_url_rule('%s/<%s:%s>' % (url, pk_type, pk), view_func=view_func,
                      methods=['GET', 'PUT', 'DELETE'])
+    if subscribe:
+        app.add_url_rule('%s/_subscribe' % url, endpoint='%s_subscribe' % endpoint, view_func=subscribe_view(view),
+                         methods=['GET'])
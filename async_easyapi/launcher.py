@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import importlib
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+
+def load_object(path: str):
+    """
+    根据 module:attr 加载对象
+    :param path:
+    :return:
+    """
+    module, _, attr = path.partition(':')
+    obj = importlib.import_module(module)
+    for name in attr.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def create_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """
+    创建开启 SO_REUSEPORT 的监听socket 每个worker单独bind 由内核分发连接
+    :param host:
+    :param port:
+    :param backlog:
+    :return:
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def new_event_loop(use_uvloop: bool = True):
+    """
+    有 uvloop 时使用 uvloop
+    :param use_uvloop:
+    :return:
+    """
+    if use_uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def serve(app, sock: socket.socket, loop):
+    """
+    在已bind的socket上用 hypercorn 运行 app
+    收到 SIGTERM/SIGINT 后关闭监听socket并退出 hypercorn 0.4 不会等待进行中的请求完成
+    :param app:
+    :param sock:
+    :param loop:
+    :return:
+    """
+    from hypercorn import Config, run_single
+    config = Config()
+    config.host, config.port = sock.getsockname()[:2]
+    run_single(app, config, loop=loop, sock=sock)
+
+
+class Launcher(object):
+    """
+    多进程启动器
+    主进程读取一次表结构后 fork 出多个 worker
+    每个 worker 拥有自己的连接池 大小为 db_connections / workers
+    SIGHUP 逐个重启 worker SIGTERM/SIGINT 退出
+    """
+
+    def __init__(self, app, dbs: list, host: str = '127.0.0.1', port: int = 8000, workers: int = None,
+                 db_connections: int = 100, use_uvloop: bool = True, restart_delay: float = 2.0):
+        """
+        :param app: quart app
+        :param dbs: 需要连接的db对象 不能在主进程中 connect
+        :param host:
+        :param port:
+        :param workers: worker 数 默认cpu核数
+        :param db_connections: 每个db在所有worker中的连接总数
+        :param use_uvloop:
+        :param restart_delay: 滚动重启时 新worker启动后等待的秒数
+        """
+        self.app = app
+        self.dbs = dbs
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.db_connections = db_connections
+        self.use_uvloop = use_uvloop
+        self.restart_delay = restart_delay
+        self._children = set()
+        self._retiring = set()
+        self._stopping = False
+        self._reload = False
+
+    def prepare(self):
+        """
+        在主进程中读取表结构 fork 之前释放同步连接
+        :return:
+        """
+        for db in self.dbs:
+            if db._tables is None:
+                db.reflect()
+            if db._sync_engine is not None:
+                db._sync_engine.dispose()
+            db.pool_size = max(1, self.db_connections // self.workers)
+
+    def run_worker(self):
+        loop = new_event_loop(self.use_uvloop)
+        for db in self.dbs:
+            loop.run_until_complete(db.connect())
+        serve(self.app, create_socket(self.host, self.port), loop)
+
+    def spawn(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # 不继承主进程的处理函数 SIGTERM/SIGINT 由 hypercorn 重新设置
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.run_worker()
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self._children.add(pid)
+        return pid
+
+    def reap(self):
+        """
+        回收退出的worker 非主动退出的重新拉起
+        :return:
+        """
+        while self._children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self._children.discard(pid)
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+            elif not self._stopping:
+                print('worker {} exited, restarting'.format(pid))
+                self.spawn()
+
+    def rolling_restart(self):
+        """
+        逐个替换worker 新旧worker共享端口 新worker启动后才停止旧worker 端口始终有worker监听
+        :return:
+        """
+        for pid in list(self._children):
+            if self._stopping:
+                return
+            self.spawn()
+            time.sleep(self.restart_delay)
+            self._retiring.add(pid)
+            self.kill(pid, signal.SIGTERM)
+
+    def kill(self, pid: int, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self._children.discard(pid)
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def reload(self, *args):
+        self._reload = True
+
+    def run(self):
+        self.prepare()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for _ in range(self.workers):
+            self.spawn()
+        print('running {} workers on {}:{}'.format(self.workers, self.host, self.port))
+        while not self._stopping:
+            if self._reload:
+                self._reload = False
+                self.rolling_restart()
+            self.reap()
+            time.sleep(0.5)
+        for pid in list(self._children):
+            self.kill(pid, signal.SIGTERM)
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self._children.discard(pid)
+
+
+def run(app, dbs: list, host: str = '127.0.0.1', port: int = 8000, workers: int = None, db_connections: int = 100,
+        use_uvloop: bool = True):
+    """
+    多进程运行 app
+    :param app:
+    :param dbs:
+    :param host:
+    :param port:
+    :param workers:
+    :param db_connections:
+    :param use_uvloop:
+    :return:
+    """
+    Launcher(app, dbs, host=host, port=port, workers=workers, db_connections=db_connections,
+             use_uvloop=use_uvloop).run()
+
+
+def main(argv=None):
+    """
+    python -m async_easyapi.launcher example.user:app --db example.user:my_db --workers 4
+    :param argv:
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='run a quart app with pre-forked workers')
+    parser.add_argument('app', help='module:app')
+    parser.add_argument('--db', action='append', default=[], help='module:db, can be repeated')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--db-connections', type=int, default=100)
+    parser.add_argument('--no-uvloop', action='store_true')
+    args = parser.parse_args(argv)
+    sys.path.insert(0, os.getcwd())
+    run(load_object(args.app), [load_object(db) for db in args.db], host=args.host, port=args.port,
+        workers=args.workers, db_connections=args.db_connections, use_uvloop=not args.no_uvloop)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,18 @@
 import abc
+import asyncio
 import functools
+import inspect
+import quart
+from easyapi_tools.cache import MISSING
 
 
 class AbcPermission(metaclass=abc.ABCMeta):
+    """
+    权限检查 check 可以是普通函数或协程
+    设置 __cache__ = TTLCache(ttl=60) 并重载 principal 后 决策按 (principal, 权限, 参数) 缓存
+    同一个请求中相同的检查只执行一次
+    """
+    __cache__ = None
 
     @classmethod
     @abc.abstractmethod
@@ -20,14 +30,194 @@ class AbcPermission(metaclass=abc.ABCMeta):
     def fail(cls):
         raise NotImplementedError
 
+    @classmethod
+    def principal(cls):
+        """
+        当前请求的用户标识 可以是协程 返回 None 时不使用 __cache__
+        :return:
+        """
+        return None
+
+    @classmethod
+    def key(cls, args: tuple, kwargs: dict) -> tuple:
+        return (cls.__module__, cls.__qualname__, args, tuple(sorted(kwargs.items())))
+
+    @staticmethod
+    def _memo():
+        # 请求内的检查结果
+        if not quart.has_request_context():
+            return None
+        memo = getattr(quart.g, '_permission_memo', None)
+        if memo is None:
+            memo = quart.g._permission_memo = {}
+        return memo
+
+    @classmethod
+    def _recall(cls, key: tuple, principal=None):
+        """
+        依次查找请求内结果和缓存
+        :param key:
+        :param principal: 为 None 时不查找缓存
+        :return: 没有时返回 MISSING
+        """
+        memo = cls._memo()
+        if memo is not None and key in memo:
+            return memo[key]
+        if principal is not None:
+            return cls.__cache__.get((principal,) + key, MISSING)
+        return MISSING
+
+    @classmethod
+    def _remember(cls, key: tuple, principal, result) -> bool:
+        result = bool(result)
+        if principal is not None:
+            cls.__cache__.set((principal,) + key, result)
+        memo = cls._memo()
+        if memo is not None:
+            memo[key] = result
+        return result
+
+    @classmethod
+    async def decide(cls, *args, **kwargs) -> bool:
+        """
+        执行检查 依次使用请求内结果 缓存 check
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        key = cls.key(args, kwargs)
+        result = cls._recall(key)
+        if result is not MISSING:
+            return result
+        principal = None
+        if cls.__cache__ is not None:
+            principal = cls.principal()
+            if inspect.isawaitable(principal):
+                principal = await principal
+            result = cls._recall(key, principal)
+            if result is not MISSING:
+                return cls._remember(key, None, result)
+        result = cls.check(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return cls._remember(key, principal, result)
+
+    @classmethod
+    def decide_sync(cls, *args, **kwargs) -> bool:
+        """
+        同步函数中的 decide 与 decide 共用请求内结果和缓存 check 与 principal 不能是协程
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        key = cls.key(args, kwargs)
+        result = cls._recall(key)
+        if result is not MISSING:
+            return result
+        principal = None
+        if cls.__cache__ is not None:
+            principal = _sync_result(cls.principal(), '{}.principal'.format(cls.__name__))
+            result = cls._recall(key, principal)
+            if result is not MISSING:
+                return cls._remember(key, None, result)
+        result = _sync_result(cls.check(*args, **kwargs), '{}.check'.format(cls.__name__))
+        return cls._remember(key, principal, result)
+
+    @classmethod
+    async def decide_many(cls, args_list: list) -> list:
+        """
+        批量检查 相同的参数只检查一次
+        :param args_list: 每次检查的参数 tuple
+        :return: 与 args_list 对应的结果
+        """
+        unique = list(dict.fromkeys(tuple(args) for args in args_list))
+        results = await asyncio.gather(*[cls.decide(*args) for args in unique])
+        decisions = dict(zip(unique, results))
+        return [decisions[tuple(args)] for args in args_list]
+
+    @classmethod
+    def invalidate(cls, principal=None, *args, **kwargs) -> int:
+        """
+        删除缓存的决策 例如角色变更后调用
+        :param principal: 为 None 时删除所有用户的
+        :param args: 指定参数时只删除该参数的
+        :return: 删除的条数
+        """
+        if cls.__cache__ is None:
+            return 0
+        prefix = cls.key((), {})[:2]
+        exact = cls.key(args, kwargs) if args or kwargs else None
+
+        def predicate(key):
+            if principal is not None and key[0] != principal:
+                return False
+            if exact is not None:
+                return key[1:] == exact
+            return key[1:3] == prefix
+        return cls.__cache__.invalidate(predicate)
+
+    @classmethod
+    async def reject(cls):
+        result = cls.fail()
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
     @classmethod
     def permission(cls, *args, **kwargs):
         def f_wrapper(f):
+            if asyncio.iscoroutinefunction(f):
+                @functools.wraps(f)
+                async def wrapper(*k_args, **k_kwargs):
+                    if await cls.decide(*args, **kwargs):
+                        return await f(*k_args, **k_kwargs)
+                    else:
+                        return await cls.reject()
+                return wrapper
+
+            # 同步函数无法等待协程 check 协程对象总为真 会跳过权限检查
+            if inspect.iscoroutinefunction(cls.check):
+                raise TypeError('{}.check is a coroutine function, {} must be async'.format(cls.__name__,
+                                                                                         f.__name__))
+
             @functools.wraps(f)
             def wrapper(*k_args, **k_kwargs):
-                if cls.check(*args, **kwargs):
+                if cls.decide_sync(*args, **kwargs):
                     return f(*k_args, **k_kwargs)
                 else:
                     return cls.fail()
             return wrapper
         return f_wrapper
+
+
+def _sync_result(result, name: str):
+    # 同步函数无法等待协程 协程对象总为真 会跳过权限检查
+    if inspect.isawaitable(result):
+        if inspect.iscoroutine(result):
+            result.close()
+        raise TypeError('{} returned an awaitable in a sync function'.format(name))
+    return result
+
+
+def normalize_permissions(permissions: dict) -> dict:
+    """
+    将 handler 的 __permissions__ 规范为 {方法: [(权限类, 参数)]}
+    值可以是权限类 (权限类, 参数...) 或它们的列表 '*' 对所有方法生效
+    :param permissions:
+    :return:
+    """
+    def specs(value):
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return [spec for item in value for spec in specs(item)]
+        if isinstance(value, tuple):
+            return [(value[0], tuple(value[1:]))]
+        return [(value, ())]
+
+    common = specs(permissions.get('*'))
+    normalized = {'*': common}
+    for method, value in permissions.items():
+        if method != '*':
+            normalized[method.lower()] = common + specs(value)
+    return normalized
@@ -0,0 +1,167 @@
+import hashlib
+import mmap
+import multiprocessing
+import re
+import struct
+import time
+from collections import OrderedDict
+
+# handler 区分的请求类型 list 查询 写入 导出(聚合) 单个资源读取
+QUERY = 'query'
+WRITE = 'write'
+EXPORT = 'export'
+READ = 'read'
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+_RATE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*/\s*([1-9]\d*)?\s*([smh])\s*$')
+
+
+def parse_rate(spec) -> (float, float):
+    """
+    解析限流配置
+    :param spec: '20/s' '600/m' '1000/h' 或 (每秒令牌数, 桶容量) 字符串的桶容量为一个周期的请求数
+    :return: (每秒令牌数, 桶容量)
+    """
+    if isinstance(spec, (tuple, list)):
+        rate, burst = map(float, spec)
+    else:
+        match = _RATE.match(spec)
+        if match is None:
+            raise ValueError('invalid rate limit {!r}'.format(spec))
+        count, period, unit = match.groups()
+        seconds = _UNITS[unit] * (int(period) if period else 1)
+        rate, burst = float(count) / seconds, float(count)
+    if rate <= 0 or burst <= 0:
+        raise ValueError('rate limit {!r} should be positive'.format(spec))
+    return rate, burst
+
+
+def normalize_rate_limits(rate_limits: dict) -> dict:
+    """
+    将 handler 的 __rate_limits__ 规范为 {请求类型: (每秒令牌数, 桶容量)} 值为 None 的类型不限流
+    :param rate_limits:
+    :return:
+    """
+    return {kind: parse_rate(spec) for kind, spec in (rate_limits or {}).items() if spec is not None}
+
+
+class TokenBucketLimiter(object):
+    """
+    进程内的令牌桶 每个 key 只保存 [令牌数, 更新时间, 桶满的时间]
+    桶已经满的 key 与不存在相同 按最久未使用的顺序淘汰 最多保存 max_keys 个
+    """
+
+    def __init__(self, max_keys: int = 100000, timer=time.monotonic):
+        self.max_keys = max_keys
+        self._timer = timer
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key, rate: float, burst: float, cost: float = 1) -> float:
+        """
+        取 cost 个令牌
+        :param key:
+        :param rate: 每秒补充的令牌数
+        :param burst: 桶容量
+        :param cost:
+        :return: 0 表示允许 否则为需要等待的秒数
+        """
+        now = self._timer()
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            tokens = burst
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            buckets.move_to_end(key)
+        if tokens < cost:
+            if bucket is not None:
+                bucket[0], bucket[1] = tokens, now
+            return (cost - tokens) / rate
+        tokens -= cost
+        full_at = now + (burst - tokens) / rate
+        if bucket is None:
+            buckets[key] = [tokens, now, full_at]
+        else:
+            bucket[0], bucket[1], bucket[2] = tokens, now, full_at
+        self._evict(now)
+        return 0
+
+    def _evict(self, now: float):
+        # 每次最多检查几个最久未使用的 key 均摊 O(1)
+        buckets = self._buckets
+        for _ in range(2):
+            if not buckets:
+                return
+            key, bucket = next(iter(buckets.items()))
+            if bucket[2] > now and len(buckets) <= self.max_keys:
+                return
+            del buckets[key]
+
+
+class SharedTokenBucketLimiter(object):
+    """
+    多个 worker 进程共享的令牌桶 状态放在匿名共享内存中 需要在 fork worker 之前创建 (例如在 app 模块中)
+    key 按 hash 放入固定数量的槽 槽用完时复用桶已满或最久未更新的槽
+    """
+    _SLOT = struct.Struct('Qddd')
+    _PROBES = 8
+
+    def __init__(self, slots: int = 65536, stripes: int = 64, timer=time.monotonic):
+        """
+        :param slots: 同时限流的 key 数上限 每个槽 32 字节
+        :param stripes: 锁的分段数 不同分段的 key 可以同时更新
+        :param timer: 需要所有进程一致的时钟
+        """
+        self.stripes = stripes
+        self.per_stripe = max(self._PROBES, slots // stripes)
+        self._timer = timer
+        self._memory = mmap.mmap(-1, self._SLOT.size * self.per_stripe * stripes)
+        self._locks = [multiprocessing.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def _hash(key) -> int:
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def acquire(self, key, rate: float, burst: float, cost: float = 1) -> float:
+        """
+        与 TokenBucketLimiter.acquire 相同
+        """
+        h = self._hash(key)
+        stripe = h % self.stripes
+        base = stripe * self.per_stripe
+        start = (h // self.stripes) % self.per_stripe
+        slot_size = self._SLOT.size
+        memory = self._memory
+        with self._locks[stripe]:
+            now = self._timer()
+            target = free = victim = None
+            victim_updated = 0
+            for probe in range(self._PROBES):
+                offset = (base + (start + probe) % self.per_stripe) * slot_size
+                slot_hash, tokens, updated, full_at = self._SLOT.unpack_from(memory, offset)
+                if slot_hash == h:
+                    target = offset
+                    tokens = min(burst, tokens + (now - updated) * rate)
+                    break
+                if slot_hash == 0 or full_at <= now:
+                    # 空槽或桶已满的槽可以直接使用
+                    if free is None:
+                        free = offset
+                elif victim is None or updated < victim_updated:
+                    victim, victim_updated = offset, updated
+            if target is None:
+                target = free if free is not None else victim
+                tokens = burst
+            if tokens < cost:
+                self._SLOT.pack_into(memory, target, h, tokens, now, now + (burst - tokens) / rate)
+                return (cost - tokens) / rate
+            tokens -= cost
+            self._SLOT.pack_into(memory, target, h, tokens, now, now + (burst - tokens) / rate)
+            return 0
+
+
+default_limiter = TokenBucketLimiter()
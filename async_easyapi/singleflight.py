@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+
+def flight_key(*parts) -> str:
+    """
+    将参数规范化为 key 字典按key排序
+    :param parts:
+    :return:
+    """
+    return json.dumps(parts, sort_keys=True, default=str)
+
+
+class SingleFlight(object):
+    """
+    合并相同 key 的并发调用 只执行一次 所有调用者共享结果
+    调用结束后立即移除 不做任何缓存
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        执行 fn(*args, **kwargs) 若相同 key 的调用正在进行则等待其结果
+        某个调用者被取消不会影响其他调用者
+        :param key:
+        :param fn: 协程函数
+        :return:
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = future
+
+            def done(f):
+                if self._calls.get(key) is f:
+                    del self._calls[key]
+            future.add_done_callback(done)
+        return await asyncio.shield(future)
@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from easyapi.executor import serial_calls
+from easyapi_tools.errors import BusinessError
+
+try:
+    import contextvars
+except ImportError:  # python < 3.7
+    contextvars = None
+
+
+def engine_capacity(engine) -> int:
+    """
+    sqlalchemy 连接池最多能同时给出的连接数 pool_size + max_overflow
+    :param engine:
+    :return: 无法判断时返回 0
+    """
+    pool = getattr(engine, 'pool', None)
+    if pool is None or not hasattr(pool, 'size'):
+        return 0
+    return pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+
+
+def controller_capacity(controller, default: int = 10) -> int:
+    """
+    同步 controller 背后 db 的连接数 线程数超过该值只会在连接池上排队
+    :param controller:
+    :param default:
+    :return:
+    """
+    db = getattr(getattr(controller, '__dao__', None), '__db__', None)
+    if db is None:
+        return default
+    engines = [db.__dict__.get('_engine'), db.__dict__.get('_read_engine')]
+    capacity = sum(engine_capacity(engine) for engine in engines if engine is not None)
+    return capacity or default
+
+
+class SyncController(object):
+    """
+    在线程池中运行同步的 easyapi controller 供 QuartBaseHandler 使用
+    线程数默认等于 controller 对应连接池的大小 超出的调用在线程池队列中等待
+    线程中的 easyapi.parallel 串行执行 每个请求最多占用一个连接
+    用法:
+        class UserHandler(QuartBaseHandler):
+            __controller__ = SyncController(easyapi_user.UserController, timeout=10)
+    __controller__ 为同步 controller 时 handler 会自动包装
+    """
+
+    def __init__(self, controller, max_workers: int = None, timeout: float = None, max_queue: int = None):
+        """
+        :param controller: easyapi.BaseController 的子类
+        :param max_workers: 线程数 默认在第一次调用时读取连接池大小
+        :param timeout: 每次调用的超时秒数 超时返回 504
+        :param max_queue: 排队调用数上限 超过直接返回 503 默认不限制
+        """
+        self.controller = controller
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.submitted = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.max_queued = 0
+        self._queued = 0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # 延迟创建 此时 db 已经 connect 且不会在 fork 之前启动线程
+        if self._executor is None:
+            self.max_workers = self.max_workers or controller_capacity(self.controller)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def stats(self) -> dict:
+        """
+        线程池的运行情况
+        :return:
+        """
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'queued': self._queued,
+                'running': self._running,
+                'max_queued': self.max_queued,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+            }
+
+    def _call(self, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            # parallel 并发的 count 等会再占用一个连接 使连接数超过按线程数估算的大小
+            with serial_calls():
+                return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+
+    def _cancelled(self, future):
+        # 还在队列中就被取消的调用不会进入 _call
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    async def run(self, fn, *args, timeout: float = None, **kwargs):
+        """
+        在线程池中执行 fn 并等待结果 当前的 contextvars 会传递到线程中
+        超时或调用方被取消时 尚未开始的调用会从队列中移除 已开始的调用会执行完 但结果被丢弃
+        :param fn:
+        :param timeout: 覆盖默认超时
+        :return:
+        """
+        with self._lock:
+            if self.max_queue is not None and self._queued >= self.max_queue:
+                self.rejected += 1
+                raise BusinessError(code=503, http_code=503, err_info='too many pending requests')
+            self._queued += 1
+            self.submitted += 1
+            self.max_queued = max(self.max_queued, self._queued)
+        call = functools.partial(self._call, fn, args, kwargs)
+        if contextvars is not None:
+            call = functools.partial(contextvars.copy_context().run, call)
+        try:
+            future = self.executor.submit(call)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            raise
+        future.add_done_callback(self._cancelled)
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise BusinessError(code=504, http_code=504, err_info='request timeout')
+
+    def __getattr__(self, item):
+        """
+        controller 的方法包装为协程 其他属性直接返回
+        :param item:
+        :return:
+        """
+        attr = getattr(self.controller, item)
+        if not callable(attr) or isinstance(attr, type):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return wrapper
+
+    def close(self, wait: bool = True):
+        """
+        关闭线程池
+        :param wait: 是否等待正在执行的调用
+        :return:
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -1,5 +1,9 @@
+import functools
 from easyapi_tools.errors import BusinessError
+from easyapi_tools.util import parse_metric
+from easyapi_tools.validator import SchemaValidator
 from sqlalchemy.exc import OperationalError, IntegrityError, DataError
+from .executor import parallel, THREAD
 
 
 class ControllerMetaClass(type):
@@ -8,11 +12,21 @@ class ControllerMetaClass(type):
             return type.__new__(cls, name, bases, attrs)
         if attrs.get('__dao__') is None:
             raise NotImplementedError("Should have __dao__ value.")
-        cls.__validator__ = attrs.get('__validator__', None)
+        validator = attrs.get('__validator__')
+        if isinstance(validator, dict):
+            validator = attrs['__validator__'] = SchemaValidator(validator)
+        if isinstance(validator, SchemaValidator):
+            validator.bind(attrs['__dao__'])
         return type.__new__(cls, name, bases, attrs)
 
 
 class BaseController(metaclass=ControllerMetaClass):
+    __validator__ = None
+    __aggregate_columns__ = ()
+    __relations__ = {}
+    # 互不依赖的 dao 调用的执行方式 thread gevent serial
+    __execution__ = THREAD
+
     @classmethod
     def formatter(cls, data: dict):
         """
@@ -56,13 +70,93 @@ class BaseController(metaclass=ControllerMetaClass):
         :param sorter:
         :return:
         """
+        # 复制后再取出 _include 不修改调用方的 query
+        query = dict(query) if query else query
+        include = query.pop('_include', None) if query else None
+        query = cls.reformatter(data=query)
+        try:
+            # 两个调用可能在不同线程中执行 各自使用一份 query
+            res, total = parallel(functools.partial(cls.__dao__.query, query=dict(query or {}), pager=pager,
+                                                    sorter=sorter),
+                                  functools.partial(cls.__dao__.count, query=dict(query or {})),
+                                  strategy=cls.__execution__)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        data = list(map(cls.formatter, res))
+        if include:
+            cls.include(include, res, data)
+        return data, total
+
+    @classmethod
+    def include(cls, names: list, rows: list, results: list):
+        """
+        批量加载关联资源 每个关联只查询一次
+        :param names: 关联名 在 __relations__ 中声明 (也可以声明在dao上)
+        :param rows: dao 返回的原始数据
+        :param results: formatter 之后的结果
+        :return:
+        """
+        relations = dict(getattr(cls.__dao__, '__relations__', {}), **cls.__relations__)
+        names = list(dict.fromkeys(names))
+        for name in names:
+            if name not in relations:
+                raise BusinessError(code=400, http_code=400, err_info='unknown include {}'.format(name))
+        loads = []
+        for name in names:
+            relation = relations[name]
+            keys = relation.keys(rows)
+            if keys:
+                loads.append(functools.partial(relation.dao.query, query=relation.query(keys)))
+            else:
+                loads.append(list)
+        try:
+            related = parallel(*loads, strategy=cls.__execution__)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        for name, items in zip(names, related):
+            relations[name].stitch(name, rows, results, items)
+
+    @classmethod
+    def version(cls, query: dict, *args, **kwargs):
+        """
+        满足条件的资源的版本 用于生成 ETag
+        :param query:
+        :return: dao 不支持版本时返回 None
+        """
+        query = cls.reformatter(data=query)
+        try:
+            return cls.__dao__.version(query=query)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+
+    @classmethod
+    def aggregate(cls, query: dict, group_by: list, metrics: list, *args, **kwargs) -> list:
+        """
+        分组聚合 只允许使用 __aggregate_columns__ 中的列
+        :param query:
+        :param group_by:
+        :param metrics:
+        :return:
+        """
+        if group_by is None:
+            group_by = []
+        if metrics is None:
+            metrics = ['count:*']
+        if not isinstance(group_by, list) or not isinstance(metrics, list):
+            raise BusinessError(code=400, http_code=400, err_info='_group_by and _metrics should be list')
+        try:
+            columns = group_by + [parse_metric(metric)[1] for metric in metrics]
+        except ValueError as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
+        for column in columns:
+            if column != '*' and column not in cls.__aggregate_columns__:
+                raise BusinessError(code=400, http_code=400, err_info='aggregate on {} is not allowed'.format(column))
         query = cls.reformatter(data=query)
         try:
-            res = cls.__dao__.query(query=query, pager=pager, sorter=sorter)
-            total = cls.__dao__.count(query=query)
+            res = cls.__dao__.aggregate(query=query, group_by=group_by, metrics=metrics)
         except (OperationalError, IntegrityError, DataError) as e:
             raise BusinessError(code=500, http_code=500, err_info=str(e))
-        return list(map(cls.formatter, res)), total
+        return res
 
     @classmethod
     def insert(cls, data: dict, *args, **kwargs):
@@ -81,6 +175,23 @@ class BaseController(metaclass=ControllerMetaClass):
             raise BusinessError(code=500, http_code=500, err_info=str(e))
         return res
 
+    @classmethod
+    def insert_many(cls, data_list: list, *args, **kwargs):
+        """
+        批量插入资源 整批校验通过后一次写入
+        :param data_list:
+        :return: 插入的行数
+        """
+        if cls.__validator__ is not None:
+            err = cls.__validator__.validate_many(data_list)
+            if err is not None:
+                raise BusinessError(code=500, http_code=200, err_info=err)
+        try:
+            res = cls.__dao__.insert_many(data_list=data_list)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
+
     @classmethod
     def update(cls, id: int, data: dict, *args, **kwargs):
         """
@@ -90,7 +201,7 @@ class BaseController(metaclass=ControllerMetaClass):
         :return:
         """
         if cls.__validator__ is not None:
-            err = cls.__validator__.validate(data)
+            err = cls.__validator__.validate_update(data)
             if err is not None:
                 raise BusinessError(code=500, http_code=200, err_info=err)
         query = {"id": id}
@@ -1,5 +1,6 @@
-from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy import create_engine, MetaData, Table, event
 from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
 
 
 def get_mysql_engine(user, password, host, port, database, pool_size=100, echo=False):
@@ -50,6 +51,42 @@ def get_postgre_engine(user, password, host, port, database, pool_size=100, echo
     return engine
 
 
+def get_sqlite_engine(path, pool_size=5, wal=True, echo=False):
+    print('sqlite:///{path}'.format(path=path))
+    engine = create_engine(
+        'sqlite:///{path}'.format(path=path),
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+        connect_args={'check_same_thread': False},
+        echo=echo
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    return engine
+
+
+def is_read_sql(sql):
+    """
+    判断sql是否为只读查询 用于读写分离
+    :param sql:
+    :return:
+    """
+    if isinstance(sql, Select):
+        return True
+    if isinstance(sql, str):
+        return sql.lstrip().lower().startswith(('select', 'with', 'pragma', 'explain'))
+    return False
+
+
 class MysqlDB(object):
     """
     用于操作 mysql 的db对象
@@ -145,3 +182,56 @@ class PostgreDB(object):
                 return conn.execute(sql, *args, **kwargs)
         else:
             return conn.execute(sql, *args, **kwargs)
+
+
+class SqliteDB(object):
+    """
+    用于操作 sqlite 的db对象 多个读连接 + 一个串行的写连接
+    """
+
+    def __init__(self, path, pool_size=5, wal=True, echo=False):
+        self.path = path
+        self.pool_size = pool_size
+        self.wal = wal
+        self.echo = echo
+        self._engine = None
+        self._read_engine = None
+        self._metadata = None
+        self._tables = None
+
+    def connect(self):
+        """
+        _engine 为唯一的写连接 get_tx 的事务也走这里
+        :return:
+        """
+        self._engine = get_sqlite_engine(path=self.path, pool_size=1, wal=self.wal, echo=self.echo)
+        self._read_engine = get_sqlite_engine(path=self.path, pool_size=self.pool_size, wal=self.wal,
+                                              echo=self.echo)
+        self._metadata = MetaData(self._engine)
+        self._metadata.reflect(bind=self._engine)
+        self._tables = self._metadata.tables
+
+    def __getitem__(self, name):
+        return self._tables[name]
+
+    def __getattr__(self, item):
+        return self._tables[item]
+
+    def execute(self, sql, ctx: dict = None, *args, **kwargs, ):
+        """
+        执行sql 只读查询走读连接池 其余走写连接
+        :param ctx:
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        conn = None
+        if ctx is not None:
+            conn = ctx.get("connection", None)
+        if conn is None:
+            engine = self._read_engine if is_read_sql(sql) else self._engine
+            with engine.connect(close_with_result=True) as conn:
+                return conn.execute(sql, *args, **kwargs)
+        else:
+            return conn.execute(sql, *args, **kwargs)
@@ -0,0 +1,105 @@
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+THREAD = 'thread'
+GEVENT = 'gevent'
+SERIAL = 'serial'
+
+_executor = None
+_max_workers = 20
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(max_workers: int):
+    """
+    设置共享线程池的线程数 需要在第一次 parallel 之前调用
+    线程数不要超过连接池的大小
+    :param max_workers:
+    :return:
+    """
+    global _max_workers, _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _max_workers = max_workers
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=_max_workers)
+    return _executor
+
+
+@contextlib.contextmanager
+def serial_calls():
+    """
+    在其中调用的 parallel 全部串行执行
+    用于每个线程只应占用一个连接的场景 例如 async_easyapi.SyncController 按连接池大小创建的线程
+    :return:
+    """
+    previous = getattr(_local, 'serial', False)
+    _local.serial = True
+    try:
+        yield
+    finally:
+        _local.serial = previous
+
+
+def _call_in_pool(call):
+    _local.serial = True
+    return call()
+
+
+def _run_serial(calls) -> list:
+    return [call() for call in calls]
+
+
+def _run_threads(calls) -> list:
+    executor = get_executor()
+    futures = [executor.submit(_call_in_pool, call) for call in calls[1:]]
+    # 第一个调用在当前线程执行 少占用一个线程
+    try:
+        first = calls[0]()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
+    return [first] + [future.result() for future in futures]
+
+
+def _run_greenlets(calls) -> list:
+    import gevent
+    jobs = [gevent.spawn(call) for call in calls]
+    gevent.joinall(jobs)
+    for job in jobs:
+        if job.exception is not None:
+            raise job.exception
+    return [job.value for job in jobs]
+
+
+def parallel(*calls, strategy: str = THREAD) -> list:
+    """
+    并发执行多个互不依赖的 dao 调用 按顺序返回结果 任一调用出错时抛出该异常
+    用法:
+        users, total = parallel(partial(UserDao.query, query=query), partial(UserDao.count, query=query))
+    同一个事务(ctx)中的调用共用一个连接 不能并发
+    :param calls: 无参数的可调用对象
+    :param strategy: thread 共享线程池 gevent 使用协程(需要 gevent 的 monkey patch) serial 串行
+    :return:
+    """
+    if not calls:
+        return []
+    # 在线程池内部再次并发可能因线程耗尽而死锁 直接串行执行
+    if len(calls) == 1 or strategy == SERIAL or getattr(_local, 'serial', False):
+        return _run_serial(calls)
+    if strategy == THREAD:
+        return _run_threads(calls)
+    if strategy == GEVENT:
+        return _run_greenlets(calls)
+    raise ValueError('unknown execution strategy {}'.format(strategy))
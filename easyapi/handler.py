@@ -1,7 +1,8 @@
 import flask
 from flask import views
-from easyapi_tools.util import str2hump, DefaultUrlCondition
+from easyapi_tools.util import str2hump, DefaultUrlCondition, QueryStringUrlCondition, make_etag, etag_matches
 from easyapi_tools.errors import BusinessError
+from .permission import normalize_permissions
 
 
 class FlaskHandlerMeta(views.MethodViewType):
@@ -19,6 +20,8 @@ class FlaskHandlerMeta(views.MethodViewType):
 
         attrs['__resource__'] = attrs.get('__resource__') or str2hump(name[:-7])
         attrs['__url_condition__'] = attrs.get('__url_condition__') or DefaultUrlCondition
+        if '__permissions__' in attrs:
+            attrs['__permissions__'] = normalize_permissions(attrs['__permissions__'])
         if not attrs.get('__controller__'):
             raise NotImplementedError("Handler require a  controller.")
 
@@ -26,14 +29,98 @@ class FlaskHandlerMeta(views.MethodViewType):
 
 
 class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
+    # GET 请求的 url 参数解析
+    __query_condition__ = QueryStringUrlCondition
+    # GET 响应的缓存头 为 None 时不设置
+    __cache_control__ = 'no-cache'
+    __vary__ = ('Accept-Encoding', 'Authorization')
+    # 各个方法需要的权限 {'put': AdminPermission, 'delete': (RolePermission, 'admin'), '*': LoginPermission}
+    __permissions__ = {}
 
-    def get(self, id: int, *args, **kwargs):
+    def dispatch_request(self, *args, **kwargs):
         """
-        获取单个资源
+        检查 __permissions__ 后再分发到对应的方法
+        :return:
+        """
+        method = flask.request.method.lower()
+        for permission, permission_args in self.__permissions__.get(method, self.__permissions__.get('*', ())):
+            if not permission.decide(*permission_args):
+                return permission.fail()
+        return super().dispatch_request(*args, **kwargs)
+
+    def cacheable(self, response, etag: str = None):
+        """
+        为 GET 响应设置 Cache-Control Vary 和 ETag
+        :param response:
+        :param etag:
+        :return:
+        """
+        if self.__cache_control__:
+            response.headers['Cache-Control'] = self.__cache_control__
+        if self.__vary__:
+            response.headers['Vary'] = ', '.join(self.__vary__)
+        if etag is not None:
+            response.headers['ETag'] = etag
+        return response
+
+    def not_modified(self, etag: str):
+        return self.cacheable(flask.Response(status=304), etag)
+
+    @classmethod
+    def query_table(cls):
+        """
+        url 参数按列类型转换时使用的表 controller 没有 dao 时返回 None
+        :return:
+        """
+        dao = getattr(cls.__controller__, '__dao__', None)
+        if dao is None:
+            return None
+        return dao.__db__[dao.__tablename__]
+
+    def resource_etag(self, query: dict, *parts):
+        """
+        根据数据版本生成 ETag 不需要查询和序列化数据
+        :param query:
+        :param parts: 影响结果的其他参数
+        :return: controller 不支持版本时返回 None
+        """
+        version = self.__controller__.version(dict(query))
+        if version is None:
+            return None
+        return make_etag(self.__resource__, version, *parts)
+
+    def check_if_match(self, id):
+        """
+        校验 If-Match 当前资源的 ETag 不匹配时返回 412
         :param id:
         :return:
         """
+        header = flask.request.headers.get('If-Match')
+        if not header:
+            return
+        version = self.__controller__.version({'id': id})
+        if version is not None:
+            etag = make_etag(self.__resource__, version) if version[0] else None
+        else:
+            data = self.__controller__.get(id=id)
+            etag = make_etag(self.__resource__, data) if data else None
+        if not etag_matches(header, etag):
+            raise BusinessError(code=412, http_code=412, err_info='resource has been modified')
+
+    def get(self, id: int = None, *args, **kwargs):
+        """
+        获取单个资源 没有 id 时按 url 参数查询列表
+        If-None-Match 命中时返回 304
+        :param id:
+        :return:
+        """
+        if id is None:
+            return self.get_list(*args, **kwargs)
+        if_none_match = flask.request.headers.get('If-None-Match')
         try:
+            etag = self.resource_etag({'id': id})
+            if etag_matches(if_none_match, etag):
+                return self.not_modified(etag)
             data = self.__controller__.get(id=id, *args, **kwargs)
         except BusinessError as e:
             return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
@@ -42,19 +129,53 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
                 'msg': '',
                 'code': 404,
             }), 404
-        return flask.jsonify(**{
+        if etag is None:
+            etag = make_etag(self.__resource__, data)
+            if etag_matches(if_none_match, etag):
+                return self.not_modified(etag)
+        return self.cacheable(flask.jsonify(**{
             'msg': '',
             'code': 200,
             self.__resource__: data
-        })
+        }), etag)
+
+    def get_list(self, *args, **kwargs):
+        """
+        GET 查询列表 条件从 url 参数中解析 响应可以被 http 缓存
+        If-None-Match 命中时返回 304 带 _include 时关联资源没有版本 按内容生成 ETag
+        :return:
+        """
+        if_none_match = flask.request.headers.get('If-None-Match')
+        try:
+            query, pager, sorter = self.__query_condition__.parser(flask.request.args, table=self.query_table())
+            etag = None
+            if '_include' not in query:
+                etag = self.resource_etag(query, pager, sorter)
+                if etag_matches(if_none_match, etag):
+                    return self.not_modified(etag)
+            res, count = self.__controller__.query(query=query, pager=pager, sorter=sorter, *args, **kwargs)
+        except BusinessError as e:
+            return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
+        if etag is None:
+            etag = make_etag(self.__resource__, res, count)
+            if etag_matches(if_none_match, etag):
+                return self.not_modified(etag)
+        return self.cacheable(flask.jsonify(**{
+            'msg': '',
+            'code': 200,
+            self.__resource__ + 's': res,
+            'total': count
+        }), etag)
 
     def put(self, id, *args, **kwargs):
         """
         新增的路由
+        带 If-Match 时资源已被修改返回 412
         :return:
         """
         body = flask.request.json
         try:
+            self.check_if_match(id)
             self.__controller__.update(id=id, data=body, *args, **kwargs)
         except BusinessError as e:
             return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
@@ -63,10 +184,12 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
     def delete(self, id, *args, **kwargs):
         """
         删除的路由
+        带 If-Match 时资源已被修改返回 412
         :param id:
         :return:
         """
         try:
+            self.check_if_match(id)
             self.__controller__.delete(id=id, *args, **kwargs)
         except BusinessError as e:
             return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
@@ -74,10 +197,18 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
 
     def post(self, *args, **kwargs):
         """
-        处理 查询和新增
+        处理 查询 聚合和新增
+        _method: GET 查询 AGG 聚合 其余为新增
+        body 为数组时批量新增
         :return:
         """
         body = flask.request.json
+        if isinstance(body, list):
+            try:
+                count = self.__controller__.insert_many(body, *args, **kwargs)
+            except BusinessError as e:
+                return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
+            return flask.jsonify(code=200, msg='', count=count)
         method = body.get("_method") or "POST"
 
         if method == 'GET':
@@ -93,6 +224,18 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
                 self.__resource__ + 's': res,
                 'total': count
             })
+        elif method == 'AGG':
+            query, _, _ = self.__url_condition__.parser(body.get("_args"))
+            try:
+                res = self.__controller__.aggregate(query=query, group_by=body.get("_group_by"),
+                                                    metrics=body.get("_metrics"), *args, **kwargs)
+            except BusinessError as e:
+                return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
+            return flask.jsonify(**{
+                'msg': '',
+                'code': 200,
+                'aggregations': res
+            })
         else:
             if '_method' in body:
                 del body['_method']
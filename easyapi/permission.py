@@ -1,8 +1,16 @@
 import abc
 import functools
+import flask
+from easyapi_tools.cache import MISSING
 
 
 class AbcPermission(metaclass=abc.ABCMeta):
+    """
+    权限检查
+    设置 __cache__ = TTLCache(ttl=60) 并重载 principal 后 决策按 (principal, 权限, 参数) 缓存
+    同一个请求中相同的检查只执行一次
+    """
+    __cache__ = None
 
     @classmethod
     @abc.abstractmethod
@@ -20,14 +28,121 @@ class AbcPermission(metaclass=abc.ABCMeta):
     def fail(cls):
         raise NotImplementedError
 
+    @classmethod
+    def principal(cls):
+        """
+        当前请求的用户标识 返回 None 时不使用 __cache__
+        :return:
+        """
+        return None
+
+    @classmethod
+    def key(cls, args: tuple, kwargs: dict) -> tuple:
+        return (cls.__module__, cls.__qualname__, args, tuple(sorted(kwargs.items())))
+
+    @staticmethod
+    def _memo():
+        # 请求内的检查结果
+        if not flask.has_request_context():
+            return None
+        memo = getattr(flask.g, '_permission_memo', None)
+        if memo is None:
+            memo = flask.g._permission_memo = {}
+        return memo
+
+    @classmethod
+    def decide(cls, *args, **kwargs) -> bool:
+        """
+        执行检查 依次使用请求内结果 缓存 check
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        key = cls.key(args, kwargs)
+        memo = cls._memo()
+        if memo is not None and key in memo:
+            return memo[key]
+        principal = None
+        if cls.__cache__ is not None:
+            principal = cls.principal()
+        result = MISSING
+        if principal is not None:
+            result = cls.__cache__.get((principal,) + key, MISSING)
+        if result is MISSING:
+            result = bool(cls.check(*args, **kwargs))
+            if principal is not None:
+                cls.__cache__.set((principal,) + key, result)
+        if memo is not None:
+            memo[key] = result
+        return result
+
+    @classmethod
+    def decide_many(cls, args_list: list) -> list:
+        """
+        批量检查 相同的参数只检查一次
+        :param args_list: 每次检查的参数 tuple
+        :return: 与 args_list 对应的结果
+        """
+        decisions = {}
+        for args in args_list:
+            args = tuple(args)
+            if args not in decisions:
+                decisions[args] = cls.decide(*args)
+        return [decisions[tuple(args)] for args in args_list]
+
+    @classmethod
+    def invalidate(cls, principal=None, *args, **kwargs) -> int:
+        """
+        删除缓存的决策 例如角色变更后调用
+        :param principal: 为 None 时删除所有用户的
+        :param args: 指定参数时只删除该参数的
+        :return: 删除的条数
+        """
+        if cls.__cache__ is None:
+            return 0
+        prefix = cls.key((), {})[:2]
+        exact = cls.key(args, kwargs) if args or kwargs else None
+
+        def predicate(key):
+            if principal is not None and key[0] != principal:
+                return False
+            if exact is not None:
+                return key[1:] == exact
+            return key[1:3] == prefix
+        return cls.__cache__.invalidate(predicate)
+
     @classmethod
     def permission(cls, *args, **kwargs):
         def f_wrapper(f):
             @functools.wraps(f)
             def wrapper(*k_args, **k_kwargs):
-                if cls.check(*args, **kwargs):
+                if cls.decide(*args, **kwargs):
                     return f(*k_args, **k_kwargs)
                 else:
                     return cls.fail()
             return wrapper
         return f_wrapper
+
+
+def normalize_permissions(permissions: dict) -> dict:
+    """
+    将 handler 的 __permissions__ 规范为 {方法: [(权限类, 参数)]}
+    值可以是权限类 (权限类, 参数...) 或它们的列表 '*' 对所有方法生效
+    :param permissions:
+    :return:
+    """
+    def specs(value):
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return [spec for item in value for spec in specs(item)]
+        if isinstance(value, tuple):
+            return [(value[0], tuple(value[1:]))]
+        return [(value, ())]
+
+    common = specs(permissions.get('*'))
+    normalized = {'*': common}
+    for method, value in permissions.items():
+        if method != '*':
+            normalized[method.lower()] = common + specs(value)
+    return normalized
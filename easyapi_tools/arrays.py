@@ -0,0 +1,68 @@
+from sqlalchemy import types as sqltypes
+
+
+def numpy_dtype(column) -> str:
+    """
+    根据反射得到的列类型选择 numpy 的 dtype
+    Decimal 转为 float64 DATETIME 转为 datetime64 其余不能对应的类型为 object
+    :param column:
+    :return:
+    """
+    column_type = column.type
+    if isinstance(column_type, sqltypes.Boolean):
+        return 'bool'
+    if isinstance(column_type, sqltypes.Integer):
+        return 'int64'
+    if isinstance(column_type, sqltypes.Numeric):
+        return 'float64'
+    if isinstance(column_type, sqltypes.DateTime):
+        return 'datetime64[us]'
+    if isinstance(column_type, sqltypes.Date):
+        return 'datetime64[D]'
+    return 'object'
+
+
+def to_array(values: list, dtype: str):
+    """
+    将一列的值转换为 numpy 数组
+    有 NULL 时 整数列转为 float64 (NULL 为 nan) 布尔列转为 object 时间列的 NULL 为 NaT
+    :param values:
+    :param dtype:
+    :return:
+    """
+    import numpy
+    if dtype in ('int64', 'bool') and any(value is None for value in values):
+        dtype = 'float64' if dtype == 'int64' else 'object'
+    if dtype == 'object':
+        array = numpy.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+    if dtype == 'float64' or dtype.startswith('datetime64'):
+        # Decimal 和 None 由 numpy 转换为浮点数和 nan/NaT
+        return numpy.array(values, dtype=dtype)
+    return numpy.fromiter(values, dtype=dtype, count=len(values))
+
+
+def rows_to_arrays(columns: list, rows: list) -> dict:
+    """
+    将查询返回的行按列转换为 numpy 数组
+    :param columns: 查询的列
+    :param rows:
+    :return: {列名: 数组}
+    """
+    values = list(zip(*rows)) if rows else [() for _ in columns]
+    return {column.name: to_array(list(column_values), numpy_dtype(column))
+            for column, column_values in zip(columns, values)}
+
+
+def concat_arrays(batches: list, columns: list) -> dict:
+    """
+    合并分批取得的数组 合并后的 dtype 由 numpy 决定 (例如部分批次有 NULL 的整数列为 float64)
+    :param batches: 每批的 {列名: 数组}
+    :param columns: 列名
+    :return:
+    """
+    import numpy
+    if len(batches) == 1:
+        return batches[0]
+    return {name: numpy.concatenate([batch[name] for batch in batches]) for name in columns}
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache(object):
+    """
+    带过期时间的 LRU 缓存 线程安全
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60, timer=time.monotonic):
+        """
+        :param maxsize: 最多缓存的条数 超出后淘汰最久未使用的
+        :param ttl: 默认过期秒数
+        :param timer:
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires, value = item
+            if expires <= self._timer():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        :param key:
+        :param value:
+        :param ttl: 覆盖默认过期秒数
+        :return:
+        """
+        expires = self._timer() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None) -> int:
+        """
+        删除缓存
+        :param predicate: predicate(key) 为真的条目被删除 为 None 时全部删除
+        :return: 删除的条数
+        """
+        with self._lock:
+            if predicate is None:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        self.invalidate()
@@ -0,0 +1,169 @@
+import functools
+import json
+import re
+from collections import namedtuple
+from decimal import Decimal
+from datetime import datetime, date, time
+from sqlalchemy import types as sqltypes
+
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+# 常见类型直接调用 json 模块使用的 C 实现 不经过 JSONEncoder
+_FAST_ENCODERS = {
+    str: json.encoder.encode_basestring_ascii,
+    int: int.__repr__,
+    float: float.__repr__,
+    type(None): lambda value: 'null',
+}
+
+
+def json_value(value):
+    """
+    单个值转换为可以 json 序列化的值 与 type_to_json 的规则相同
+    :param value:
+    :return:
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return str(value)
+    return value
+
+
+def value_encoder(values: list):
+    """
+    按列中第一个非空值的类型选择编码函数 类型不同的值仍使用 JSONEncoder
+    :param values:
+    :return:
+    """
+    sample = next((value for value in values if value is not None), None)
+    fast = _FAST_ENCODERS.get(type(sample))
+    if fast is None:
+        return _encode
+    kind = type(sample)
+
+    def encode(value):
+        if type(value) is kind:
+            return fast(value)
+        if value is None:
+            return 'null'
+        return _encode(value)
+    return encode
+
+
+def column_converter(column):
+    """
+    根据列类型选择整列的转换函数 不需要转换时返回 None
+    :param column:
+    :return:
+    """
+    column_type = column.type
+    if isinstance(column_type, (sqltypes.Integer, sqltypes.String, sqltypes.Boolean, sqltypes.Float)):
+        return None
+    if isinstance(column_type, sqltypes.Numeric):
+        return lambda value: None if value is None else float(value)
+    if isinstance(column_type, (sqltypes.DateTime, sqltypes.Date, sqltypes.Time)):
+        return lambda value: None if value is None else str(value)
+    return json_value
+
+
+@functools.lru_cache(maxsize=256)
+def record_type(name: str, columns: tuple):
+    """
+    按列生成紧凑的记录类 (没有 __dict__ 的 namedtuple) 相同的列只生成一次
+    :param name: 类名 通常为表名
+    :param columns: 列名 不是合法标识符的列按位置命名 仍可以用 get 按列名读取
+    :return:
+    """
+    base = namedtuple(re.sub(r'\W', '_', name) + 'Record', columns, rename=True)
+    index = {column: i for i, column in enumerate(columns)}
+
+    class Record(base):
+        __slots__ = ()
+        __columns__ = columns
+
+        def keys(self):
+            return self.__columns__
+
+        def get(self, key, default=None):
+            i = index.get(key)
+            return default if i is None else self[i]
+
+        def to_dict(self) -> dict:
+            return dict(zip(self.__columns__, self))
+
+    Record.__name__ = Record.__qualname__ = base.__name__
+    return Record
+
+
+class CompactPage(object):
+    """
+    按列存放的查询结果 每列一个 list 不为每行生成 dict
+    值在构造时已经转换为可以 json 序列化的值 dumps 直接拼接 json 字符串
+    """
+    __slots__ = ('name', 'columns', 'data')
+
+    def __init__(self, name: str, columns: tuple, data: list):
+        """
+        :param name: 表名
+        :param columns: 列名
+        :param data: 与 columns 对应的每列的值
+        """
+        self.name = name
+        self.columns = tuple(columns)
+        self.data = data
+
+    @classmethod
+    def from_rows(cls, table, rows: list, name: str = None):
+        """
+        由查询返回的行构造 按列类型整列转换
+        :param table: 查询的表
+        :param rows:
+        :param name: 默认为表名
+        :return:
+        """
+        columns = tuple(column.name for column in table.columns)
+        data = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+        for values, column in zip(data, table.columns):
+            converter = column_converter(column)
+            if converter is not None:
+                values[:] = map(converter, values)
+        return cls(name or table.name, columns, data)
+
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+
+    def __getitem__(self, i):
+        return self.record_type()._make(values[i] for values in self.data)
+
+    def __iter__(self):
+        return map(self.record_type()._make, zip(*self.data))
+
+    def record_type(self):
+        return record_type(self.name, self.columns)
+
+    def column(self, name: str) -> list:
+        return self.data[self.columns.index(name)]
+
+    def to_dicts(self) -> list:
+        """
+        转换为与 query 相同的 dict 列表 兼容需要 dict 的调用方
+        :return:
+        """
+        return [dict(zip(self.columns, values)) for values in zip(*self.data)]
+
+    def dumps(self, orient: str = 'records') -> str:
+        """
+        序列化为 json 不生成中间的 dict
+        :param orient: records 为对象数组 与 query 的结果相同; columns 为 {列名: 数组}
+        :return:
+        """
+        if orient == 'columns':
+            return '{' + ','.join(_encode(name) + ':' + _encode(values)
+                                  for name, values in zip(self.columns, self.data)) + '}'
+        if not len(self):
+            return '[]'
+        # 每行套用同一个模板 只对值编码
+        template = '{' + ','.join(_encode(name).replace('%', '%%') + ':%s' for name in self.columns) + '}'
+        encoded = [map(value_encoder(values), values) for values in self.data]
+        return '[' + ','.join(map(template.__mod__, zip(*encoded))) + ']'
@@ -14,3 +14,13 @@ class BusinessError(Exception):
     def __str__(self):
         return 'code: {} status code: {} err information: {}'.format(str(self.code), str(self.http_code),
                                                                      str(self.err_info))
+
+
+class ConflictError(BusinessError):
+    def __init__(self, err_info='resource has been modified', code=409):
+        """
+        数据已经被其他请求修改 (版本号不一致) handler 返回 409
+        :param err_info:
+        :param code:
+        """
+        super().__init__(code=code, http_code=409, err_info=err_info)
@@ -0,0 +1,30 @@
+import importlib
+
+
+def lazy_exports(package: str, exports: tuple):
+    """
+    按需导入包的属性 (PEP 562) 只用到工具函数时不会加载 flask quart 和数据库驱动
+    用法 (在包的 __init__.py 中):
+        __getattr__, __dir__, __all__ = lazy_exports(__name__, (('.dao', ('BaseDao', )), ))
+    :param package: 包名
+    :param exports: ((模块, (属性名, ...)), ...) 模块可以是相对包的路径
+    :return: 模块级的 __getattr__ __dir__ 和 __all__
+    """
+    module_of = {}
+    for module, names in exports:
+        for name in names:
+            module_of[name] = module
+
+    def __getattr__(name):
+        module = module_of.get(name)
+        if module is None:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(package, name))
+        value = getattr(importlib.import_module(module, package), name)
+        # 缓存到包的命名空间 之后的访问不再经过 __getattr__
+        setattr(importlib.import_module(package), name, value)
+        return value
+
+    def __dir__():
+        return sorted(set(vars(importlib.import_module(package))) | set(module_of))
+
+    return __getattr__, __dir__, list(module_of)
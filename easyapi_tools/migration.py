@@ -0,0 +1,86 @@
+import sqlalchemy.exc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from easyapi.db_util import MysqlDB
+
+# 业务字段的定义 按顺序添加
+BUSINESS_COLUMNS = OrderedDict([
+    ('created_at', 'TIMESTAMP NULL DEFAULT NULL'),
+    ('updated_at', 'TIMESTAMP NULL DEFAULT NULL'),
+    ('deleted_at', 'TIMESTAMP NULL DEFAULT NULL'),
+    ('updated_by', "VARCHAR(255) NOT NULL DEFAULT ''"),
+    ('created_by', "VARCHAR(255) NOT NULL DEFAULT ''"),
+])
+
+# 依次尝试的 online ddl 选项 不支持时退回到下一个
+INSTANT_OPTIONS = ('ALGORITHM=INSTANT', 'ALGORITHM=INPLACE, LOCK=NONE', None)
+INPLACE_OPTIONS = ('ALGORITHM=INPLACE, LOCK=NONE', None)
+
+# 不支持 ALGORITHM/LOCK 选项时的错误码 (低版本不认识 INSTANT 时为语法错误)
+UNSUPPORTED_DDL_ERRORS = (1845, 1846, 1064)
+
+
+def business_field_clauses(table) -> list:
+    """
+    根据反射得到的表结构 生成还缺少的业务字段和 deleted_at 索引
+    :param table:
+    :return: ALTER TABLE 的子句 不需要修改时为空
+    """
+    clauses = ['ADD COLUMN `{}` {}'.format(name, definition)
+               for name, definition in BUSINESS_COLUMNS.items() if name not in table.columns]
+    indexed = any(index.columns.keys()[:1] == ['deleted_at'] for index in table.indexes)
+    if not indexed:
+        clauses.append('ADD INDEX `ix_{}_deleted_at` (`deleted_at`)'.format(table.name))
+    return clauses
+
+
+def business_field_statements(table) -> list:
+    """
+    每个表一条 ALTER 依次为可以尝试的 online ddl 写法
+    只加字段时 mysql 8 可以 INSTANT 加索引需要 INPLACE
+    :param table:
+    :return:
+    """
+    clauses = business_field_clauses(table)
+    if not clauses:
+        return []
+    head = 'ALTER TABLE `{}` {}'.format(table.name, ', '.join(clauses))
+    adds_index = clauses[-1].startswith('ADD INDEX')
+    options = INPLACE_OPTIONS if adds_index else INSTANT_OPTIONS
+    return [head + ', ' + option if option else head for option in options]
+
+
+def add_business_field(mysql_db: MysqlDB, tables: list = None, concurrency: int = 4, dry_run=False) -> dict:
+    """
+    增加业务字段
+    根据反射的表结构只添加缺少的字段 每个表合并为一条 ALTER 尽量使用 online ddl 多个表并发执行
+    修改后需要重新 connect 才能反射到新的字段
+    :param mysql_db:
+    :param tables: 需要修改的表 默认为全部
+    :param concurrency: 同时修改的表数
+    :param dry_run: 只返回会执行的 sql
+    :return: {表名: 执行的 sql 或错误} 不需要修改的表不在结果中
+    """
+    if mysql_db._metadata is None:
+        mysql_db.connect()
+    targets = [mysql_db[name] for name in (tables or sorted(mysql_db._tables))]
+    plans = [(table.name, business_field_statements(table)) for table in targets]
+    plans = [(name, statements) for name, statements in plans if statements]
+    if dry_run:
+        return {name: statements[0] for name, statements in plans}
+
+    def alter(statements):
+        for sql in statements:
+            try:
+                mysql_db.execute(sql)
+                print("执行 sql {}".format(sql))
+                return sql
+            except sqlalchemy.exc.DBAPIError as e:
+                code = e.orig.args[0] if e.orig is not None and e.orig.args else None
+                if sql is statements[-1] or code not in UNSUPPORTED_DDL_ERRORS:
+                    print("错误{}".format(e))
+                    return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(plans) or 1))) as executor:
+        results = executor.map(alter, [statements for _, statements in plans])
+        return OrderedDict(zip([name for name, _ in plans], results))
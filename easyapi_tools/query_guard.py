@@ -0,0 +1,223 @@
+import logging
+import threading
+from collections import Counter
+from easyapi_tools.errors import BusinessError
+
+logger = logging.getLogger(__name__)
+
+INDEXED = 'indexed'
+PARTIAL = 'partial'
+SCAN = 'scan'
+
+RANGE_PREFIXES = ('_gte_', '_lte_', '_gt_', '_lt_', '_like_')
+
+
+def query_shape(query: dict, order_by: str = None, scope_columns: tuple = ()) -> (tuple, tuple, str):
+    """
+    将查询条件归纳为 (等值列, 范围列, 排序列)
+    :param query: search_sql 的查询条件
+    :param order_by:
+    :param scope_columns: 值为 None 时不计入条件的列 (软删除的 deleted_at)
+    :return:
+    """
+    equals = set()
+    ranges = set()
+    for k in query.keys():
+        if k in scope_columns and query[k] is None:
+            continue
+        for prefix in RANGE_PREFIXES:
+            if k.startswith(prefix):
+                ranges.add(k[len(prefix):])
+                break
+        else:
+            if k.startswith('_in_'):
+                equals.add(k[4:])
+            else:
+                equals.add(k)
+    return tuple(sorted(equals)), tuple(sorted(ranges - equals)), order_by
+
+
+def table_indexes(table) -> list:
+    """
+    读取反射得到的索引 主键放在第一个
+    二级索引末尾隐含主键列(innodb)
+    :param table:
+    :return: 每个索引的有序列名
+    """
+    indexes = []
+    primary_key = [column.name for column in table.primary_key.columns]
+    if primary_key:
+        indexes.append(tuple(primary_key))
+    for index in table.indexes:
+        columns = [column.name for column in index.columns]
+        columns.extend(name for name in primary_key if name not in columns)
+        indexes.append(tuple(columns))
+    return indexes
+
+
+def classify(indexes: list, equals: tuple, ranges: tuple, order_by: str = None, skip: tuple = ()) -> str:
+    """
+    判断一个查询是否能走索引
+    indexed: 存在索引的最左前缀覆盖全部等值列 之后可接一个范围列或排序列
+    partial: 存在索引的首列出现在条件中或为排序列 但不能覆盖全部条件
+    scan: 没有可用索引
+    :param indexes:
+    :param equals:
+    :param ranges:
+    :param order_by:
+    :param skip: 不计入条件但有等值条件的列 索引前缀中的这些列可以跳过
+    :return:
+    """
+    filters = set(equals) | set(ranges)
+    if not filters and order_by is None:
+        return INDEXED
+    result = SCAN
+    for columns in indexes:
+        matched = set()
+        position = 0
+        while position < len(columns) and (columns[position] in equals or columns[position] in skip):
+            if columns[position] in equals:
+                matched.add(columns[position])
+            position += 1
+        ordered = False
+        if position < len(columns) and columns[position] in ranges:
+            matched.add(columns[position])
+            ordered = columns[position] == order_by
+        elif position < len(columns) and columns[position] == order_by:
+            ordered = True
+        sorted_by_index = order_by is None or ordered
+        # 按索引顺序读取时 即使条件不能使用索引 也只需扫描到凑满一页
+        if not matched and not ordered:
+            continue
+        if matched >= filters and sorted_by_index:
+            return INDEXED
+        result = PARTIAL
+    return result
+
+
+def suggest_index(equals: tuple, ranges: tuple, order_by: str = None) -> tuple:
+    """
+    根据查询形态给出组合索引 等值列在前 范围列或排序列在后
+    :param equals:
+    :param ranges:
+    :param order_by:
+    :return:
+    """
+    columns = list(equals)
+    if ranges:
+        columns.append(ranges[0])
+    elif order_by is not None and order_by not in columns:
+        columns.append(order_by)
+    return tuple(columns)
+
+
+class QueryAdvisor(object):
+    """
+    统计实际出现过的查询形态 并给出组合索引建议
+    """
+
+    def __init__(self):
+        self._shapes = Counter()
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def record(self, table_name: str, shape: tuple, level: str):
+        with self._lock:
+            self._shapes[(table_name,) + shape] += 1
+            self._levels[(table_name,) + shape] = level
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+            self._levels.clear()
+
+    def report(self) -> list:
+        """
+        按出现次数倒序给出未命中索引的查询及建议索引
+        :return:
+        """
+        with self._lock:
+            shapes = self._shapes.most_common()
+            levels = dict(self._levels)
+        report = []
+        for key, times in shapes:
+            table_name, equals, ranges, order_by = key
+            level = levels[key]
+            item = {
+                'table': table_name,
+                'equals': list(equals),
+                'ranges': list(ranges),
+                'order_by': order_by,
+                'level': level,
+                'times': times,
+                'suggestion': None,
+            }
+            if level != INDEXED:
+                columns = suggest_index(equals, ranges, order_by)
+                if columns:
+                    sql = 'CREATE INDEX idx_{table}_{name} ON {table} ({columns});'.format(
+                        table=table_name, name='_'.join(columns), columns=', '.join(columns))
+                    item['suggestion'] = sql
+            report.append(item)
+        return report
+
+
+default_advisor = QueryAdvisor()
+
+
+class QueryGuard(object):
+    """
+    dao 的查询守卫 根据索引情况 allow / warn / reject
+    用法:
+        class UserDao(BaseDao):
+            __db__ = my_db
+            __query_guard__ = QueryGuard(policy='reject')
+    """
+    ALLOW = 'allow'
+    WARN = 'warn'
+    REJECT = 'reject'
+
+    def __init__(self, policy: str = 'warn', reject_level: str = SCAN, advisor: QueryAdvisor = None,
+                 scope_columns: tuple = ('deleted_at',)):
+        """
+        :param policy: allow 仅统计 warn 记录日志 reject 直接拒绝
+        :param reject_level: 触发 warn/reject 的级别 scan 或 partial
+        :param advisor: 统计查询形态 默认使用全局 default_advisor
+        :param scope_columns: BusinessBaseDao 自动加上的 deleted_at = None 不计入条件
+        """
+        if policy not in (self.ALLOW, self.WARN, self.REJECT):
+            raise ValueError('unknown query policy {}'.format(policy))
+        self.policy = policy
+        self.reject_levels = (SCAN,) if reject_level == SCAN else (SCAN, PARTIAL)
+        self.advisor = advisor or default_advisor
+        self.scope_columns = tuple(scope_columns)
+        self._indexes = {}
+
+    def indexes(self, table) -> list:
+        indexes = self._indexes.get(table.name)
+        if indexes is None:
+            indexes = self._indexes[table.name] = table_indexes(table)
+        return indexes
+
+    def check(self, table, query: dict, order_by: str = None, record: bool = True) -> str:
+        """
+        检查一次查询
+        :param table:
+        :param query:
+        :param order_by:
+        :param record: 是否记入advisor
+        :return: 查询的级别
+        """
+        query = query or {}
+        shape = query_shape(query, order_by, self.scope_columns)
+        skip = tuple(name for name in self.scope_columns if name in query and query[name] is None)
+        level = classify(self.indexes(table), *shape, skip=skip)
+        if record:
+            self.advisor.record(table.name, shape, level)
+        if level in self.reject_levels:
+            if self.policy == self.REJECT:
+                raise BusinessError(code=400, http_code=400,
+                                    err_info='query on {} is not supported by any index'.format(table.name))
+            if self.policy == self.WARN:
+                logger.warning('%s query on %s: equals=%s ranges=%s order_by=%s', level, table.name, *shape)
+        return level
@@ -1,6 +1,15 @@
 import abc
+import hashlib
+import heapq
+import itertools
+import json
+import operator
+import re
 from decimal import Decimal
 from datetime import datetime, date, time
+from easyapi_tools.errors import BusinessError
+
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
 
 
 def str2hump(listx):
@@ -35,6 +44,190 @@ def type_to_json(data):
     return new_data
 
 
+def page_range(pager: dict) -> (int, int):
+    """
+    将分页参数转换成 (offset, limit)
+    :param pager:
+    :return:
+    """
+    if not pager:
+        return None, None
+    per_page = page_number(pager.get('_per_page'), '_per_page')
+    page = page_number(pager.get('_page'), '_page')
+    offset = None
+    limit = per_page or None
+    if page:
+        if per_page is None:
+            offset, limit = (page - 1) * 30, 30
+        else:
+            offset = (page - 1) * per_page
+    return offset, limit
+
+
+def page_number(value, name: str):
+    """
+    校验分页参数 需要是正整数 url 参数可以是数字字符串
+    :param value:
+    :param name:
+    :return: 没有传入时返回 None
+    """
+    if value is None:
+        return None
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise BusinessError(code=400, http_code=400, err_info='{} should be a positive integer'.format(name))
+    return value
+
+
+def chunks(values: list, size: int):
+    """
+    按size切分列表
+    :param values:
+    :param size:
+    :return:
+    """
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def merge_sorted(results: list, key: str, desc: bool = True, offset: int = None, limit: int = None) -> list:
+    """
+    合并多个已按key排好序的结果 并按 offset/limit 截取
+    None 与 mysql 一致 视为最小值
+    :param results:
+    :param key:
+    :param desc:
+    :param offset:
+    :param limit:
+    :return:
+    """
+    rows = heapq.merge(*results, key=lambda row: (row[key] is not None, row[key]), reverse=desc)
+    start = offset or 0
+    stop = start + limit if limit else None
+    return list(itertools.islice(rows, start, stop))
+
+
+def _match_value(op, value, target) -> bool:
+    if value is None or target is None:
+        return op is operator.eq and value is target
+    if isinstance(value, (int, float, Decimal)) and isinstance(target, str):
+        try:
+            target = float(target)
+        except ValueError:
+            return False
+    elif isinstance(value, (datetime, date)) and isinstance(target, str):
+        value = str(value)
+    try:
+        return op(value, target)
+    except TypeError:
+        return False
+
+
+def match_query(query: dict, data: dict) -> bool:
+    """
+    在内存中按 search_sql 的语义判断一行数据是否满足条件
+    data 中缺少的字段视为满足
+    :param query:
+    :param data:
+    :return:
+    """
+    for k, v in query.items():
+        if type(v) is not list:
+            values = [v]
+        else:
+            values = v
+        if k.startswith('_gt_'):
+            op, key = operator.gt, k[4:]
+        elif k.startswith('_gte_'):
+            op, key = operator.ge, k[5:]
+        elif k.startswith('_lt_'):
+            op, key = operator.lt, k[4:]
+        elif k.startswith('_lte_'):
+            op, key = operator.le, k[5:]
+        elif k.startswith('_like_'):
+            key = k[6:]
+            if key in data and (data[key] is None or
+                                not all(str(data[key]).startswith(str(target)) for target in values)):
+                return False
+            continue
+        elif k.startswith('_in_'):
+            key = k[4:]
+            if key in data and not any(_match_value(operator.eq, data[key], target) for target in values):
+                return False
+            continue
+        else:
+            if k in data and not _match_value(operator.eq, data[k], values[0]):
+                return False
+            continue
+        if key in data and not all(_match_value(op, data[key], target) for target in values):
+            return False
+    return True
+
+
+def parse_metric(metric: str) -> (str, str, str):
+    """
+    解析聚合指标 形如 sum:amount count:*
+    :param metric:
+    :return: (函数名, 列名, 结果字段名)
+    """
+    if not isinstance(metric, str):
+        raise ValueError('invalid metric {}'.format(metric))
+    name, _, column = metric.partition(':')
+    if name not in AGGREGATE_FUNCTIONS or not column or (column == '*' and name != 'count'):
+        raise ValueError('invalid metric {}'.format(metric))
+    return name, column, '{}_{}'.format(name, 'all' if column == '*' else column)
+
+
+class Relation(object):
+    """
+    资源之间的关联 用于 _include 批量加载
+    例如 用户的部门: Relation(DepartmentDao, local_key='department_id')
+    用户的订单: Relation(OrderDao, local_key='id', remote_key='user_id', many=True)
+    """
+
+    def __init__(self, dao, local_key: str, remote_key: str = 'id', many: bool = False):
+        """
+        :param dao: 关联资源的dao
+        :param local_key: 本资源上的关联列
+        :param remote_key: 关联资源上的关联列
+        :param many: 是否一对多
+        """
+        self.dao = dao
+        self.local_key = local_key
+        self.remote_key = remote_key
+        self.many = many
+
+    def keys(self, rows: list) -> list:
+        """
+        收集需要加载的关联值
+        :param rows:
+        :return:
+        """
+        return list(dict.fromkeys(row[self.local_key] for row in rows if row.get(self.local_key) is not None))
+
+    def query(self, keys: list) -> dict:
+        return {'_in_' + self.remote_key: keys}
+
+    def stitch(self, name: str, rows: list, results: list, related: list):
+        """
+        将关联资源放回到结果中
+        :param name: 结果中的字段名
+        :param rows: dao 返回的原始数据
+        :param results: formatter 之后的结果 与 rows 一一对应
+        :param related: 关联资源
+        :return:
+        """
+        index = {}
+        for item in related:
+            if self.many:
+                index.setdefault(item.get(self.remote_key), []).append(item)
+            else:
+                index.setdefault(item.get(self.remote_key), item)
+        for row, result in zip(rows, results):
+            result[name] = index.get(row.get(self.local_key), [] if self.many else None)
+
+
 class AbcUrlCondition(metaclass=abc.ABCMeta):
 
     @classmethod
@@ -65,6 +258,166 @@ class DefaultUrlCondition(AbcUrlCondition):
                     sorter['_order_by'] = v
                 elif k == '_desc':
                     sorter['_desc'] = v
+                elif k == '_include':
+                    names = v.split(',') if isinstance(v, str) else v
+                    if not isinstance(names, (list, tuple)) or not all(isinstance(name, str) for name in names):
+                        raise BusinessError(code=400, http_code=400,
+                                            err_info='_include should be a string or a list of strings')
+                    query['_include'] = list(names)
                 else:
                     query[k] = v
         return query, pager, sorter
+
+
+def parse_literal(value: str):
+    """
+    将 url 参数的字符串转换为对应类型
+    整数 小数 true/false null 转换为对应的值 以0开头的数字(如编号 电话)保持字符串
+    用引号包裹的值始终为字符串
+    :param value:
+    :return:
+    """
+    if not isinstance(value, str):
+        return value
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    if _INTEGER.match(value):
+        return int(value)
+    if _FLOAT.match(value):
+        return float(value)
+    return _KEYWORDS.get(value, value)
+
+
+_INTEGER = re.compile(r'^-?(0|[1-9]\d{0,17})$')
+_FLOAT = re.compile(r'^-?(0|[1-9]\d*)\.\d+$')
+_KEYWORDS = {'true': True, 'false': False, 'null': None}
+_BOOLEANS = {'true': True, '1': True, 'yes': True, 'false': False, '0': False, 'no': False}
+
+
+def column_literal(value, column):
+    """
+    按列类型转换 url 参数的字符串 只转换数字和布尔列 其他列保持字符串 避免字符串列与数字比较时的隐式转换
+    数字和布尔列的 null 为 NULL 无法转换时返回 400
+    :param value:
+    :param column: 反射得到的列 为 None 时不转换
+    :return:
+    """
+    if column is None or not isinstance(value, str):
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type not in (bool, int, float, Decimal):
+        return value
+    if value == 'null':
+        return None
+    try:
+        if python_type is bool:
+            return _BOOLEANS[value.lower()]
+        return python_type(value)
+    except (KeyError, ValueError, ArithmeticError):
+        raise BusinessError(code=400, http_code=400, err_info='invalid value {!r} for {}'.format(value, column.name))
+
+
+def getlist(args, key: str) -> list:
+    """
+    读取重复的 url 参数 兼容 werkzeug 的 getlist 和 multidict 的 getall
+    :param args:
+    :param key:
+    :return:
+    """
+    if hasattr(args, 'getlist'):
+        return args.getlist(key)
+    if hasattr(args, 'getall'):
+        return args.getall(key)
+    value = args[key]
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+class QueryStringUrlCondition(DefaultUrlCondition):
+    """
+    解析 GET 请求的 url 参数
+    ?name=a&_gt_age=18&_in_id=1,2&_in_id=3&status=1&status=2&_page=1&_per_page=20&_order_by=id&_desc=true
+    _in_ 的值可以重复或用逗号分隔 普通字段重复时视为 _in_ _like_ 的值不做类型转换
+    _gt_ _gte_ _lt_ _lte_ 重复时所有条件同时生效 其他以 _ 开头的操作符不能重复
+    值按 table 中的列类型转换 见 column_literal
+    """
+    PAGER_KEYS = ('_page', '_per_page')
+    RANGE_PREFIXES = ('_gt_', '_gte_', '_lt_', '_lte_')
+    COLUMN_PREFIXES = ('_gte_', '_lte_', '_gt_', '_lt_', '_in_')
+
+    @classmethod
+    def column_name(cls, key: str) -> str:
+        for prefix in cls.COLUMN_PREFIXES:
+            if key.startswith(prefix):
+                return key[len(prefix):]
+        return key
+
+    @classmethod
+    def parser(cls, args, table=None) -> (dict, dict, dict):
+        """
+        :param args: request.args
+        :param table: 查询的表 没有时值全部保持字符串
+        :return:
+        """
+        if not args:
+            return {}, {}, {}
+
+        def literal(key, value):
+            column = table.c.get(cls.column_name(key)) if table is not None else None
+            return column_literal(value, column)
+
+        values = {}
+        for k in dict.fromkeys(args.keys()):
+            items = getlist(args, k)
+            if k in cls.PAGER_KEYS:
+                values[k] = page_number(items[-1], k)
+            elif k == '_desc':
+                values[k] = str(items[-1]).lower() in ('1', 'true', 'yes')
+            elif k in ('_order_by', '_include'):
+                values[k] = ','.join(items) if k == '_include' else items[-1]
+            elif k.startswith('_like_'):
+                values[k] = items[-1]
+            elif k.startswith('_in_'):
+                values[k] = [literal(k, v) for item in items for v in str(item).split(',') if v != '']
+            elif k.startswith(cls.RANGE_PREFIXES) and len(items) > 1:
+                values[k] = [literal(k, item) for item in items]
+            elif k.startswith('_') and len(items) > 1:
+                raise BusinessError(code=400, http_code=400, err_info='{} should not be repeated'.format(k))
+            elif len(items) > 1:
+                values['_in_' + k] = [literal(k, item) for item in items]
+            else:
+                values[k] = literal(k, items[0])
+        return super().parser(values)
+
+
+def make_etag(*parts) -> str:
+    """
+    根据数据版本或内容生成弱 ETag
+    :param parts:
+    :return:
+    """
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return 'W/"{}"'.format(digest[:24])
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    判断 If-None-Match / If-Match 是否命中 使用弱比较
+    :param header:
+    :param etag:
+    :return:
+    """
+    if not header or etag is None:
+        return False
+    if header.strip() == '*':
+        return True
+    value = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == value:
+            return True
+    return False
@@ -1,4 +1,8 @@
 import abc
+import datetime
+import decimal
+import re
+from sqlalchemy import types as sqltypes
 
 
 class AbcValidator(metaclass=abc.ABCMeta):
@@ -7,3 +11,340 @@ class AbcValidator(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def validate(cls, data):
         pass
+
+    @classmethod
+    def validate_update(cls, data):
+        """
+        校验修改的数据 默认与 validate 相同
+        :param data:
+        :return: 错误信息 没有错误返回 None
+        """
+        return cls.validate(data)
+
+    @classmethod
+    def validate_many(cls, data_list):
+        """
+        校验批量插入的数据 默认逐行调用 validate
+        :param data_list:
+        :return: 第一个错误信息 没有错误返回 None
+        """
+        for index, data in enumerate(data_list):
+            err = cls.validate(data)
+            if err is not None:
+                return 'row {}: {}'.format(index, err)
+        return None
+
+
+# 由 dao 维护的字段 不要求调用方传入
+BUSINESS_FIELDS = ('created_at', 'updated_at', 'deleted_at', 'created_by', 'updated_by')
+
+PYTHON_TYPES = {
+    'string': (str,),
+    'integer': (int,),
+    'number': (int, float, decimal.Decimal),
+    'boolean': (bool,),
+    'null': (type(None),),
+    'array': (list, tuple),
+    'object': (dict,),
+}
+
+DATE_PATTERNS = {
+    'date': re.compile(r'^\d{4}-\d{2}-\d{2}$'),
+    'date-time': re.compile(r'^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$'),
+    'time': re.compile(r'^\d{2}:\d{2}(:\d{2}(\.\d+)?)?$'),
+}
+
+DATE_TYPES = {
+    'date': (datetime.date,),
+    'date-time': (datetime.date,),
+    'time': (datetime.time,),
+}
+
+
+def column_schema(column) -> dict:
+    """
+    根据反射得到的列类型生成 json schema
+    :param column:
+    :return:
+    """
+    column_type = column.type
+    schema = {}
+    if isinstance(column_type, sqltypes.Boolean):
+        schema['type'] = ['boolean', 'integer']
+    elif isinstance(column_type, sqltypes.Integer):
+        schema['type'] = ['integer']
+        # mysql 的 tinyint(1) 通常存放布尔值
+        if getattr(column_type, 'display_width', None) == 1:
+            schema['type'].append('boolean')
+    elif isinstance(column_type, sqltypes.Numeric):
+        schema['type'] = ['number']
+    elif isinstance(column_type, sqltypes.Enum):
+        schema['enum'] = list(column_type.enums)
+    elif isinstance(column_type, sqltypes.String):
+        schema['type'] = ['string']
+        if column_type.length:
+            schema['maxLength'] = column_type.length
+    elif isinstance(column_type, sqltypes.DateTime):
+        schema['type'] = ['string']
+        schema['format'] = 'date-time'
+    elif isinstance(column_type, sqltypes.Date):
+        schema['type'] = ['string']
+        schema['format'] = 'date'
+    elif isinstance(column_type, sqltypes.Time):
+        schema['type'] = ['string']
+        schema['format'] = 'time'
+    if column.nullable:
+        if 'type' in schema:
+            schema['type'].append('null')
+        if 'enum' in schema:
+            schema['enum'].append(None)
+    return schema
+
+
+def column_required(column) -> bool:
+    if column.nullable or column.default is not None or column.server_default is not None:
+        return False
+    if column.primary_key and isinstance(column.type, sqltypes.Integer):
+        return False
+    return column.name not in BUSINESS_FIELDS
+
+
+def table_schema(table) -> dict:
+    """
+    根据反射得到的表生成 json schema
+    :param table:
+    :return:
+    """
+    return {
+        'type': 'object',
+        'properties': {column.name: column_schema(column) for column in table.columns},
+        'required': [column.name for column in table.columns if column_required(column)],
+        'additionalProperties': False,
+    }
+
+
+def compile_property(name: str, schema: dict):
+    """
+    将单个字段的 schema 编译为校验函数
+    :param name:
+    :param schema:
+    :return: check(value) -> 错误信息或 None
+    """
+    checks = []
+    types = schema.get('type')
+    if isinstance(types, str):
+        types = [types]
+    nullable = types is not None and 'null' in types
+    if 'enum' in schema and None in schema['enum']:
+        nullable = True
+    fmt = schema.get('format')
+    if types is not None:
+        python_types = tuple(t for name_ in types for t in PYTHON_TYPES[name_])
+        if fmt in DATE_TYPES:
+            python_types += DATE_TYPES[fmt]
+        allow_bool = 'boolean' in types
+        type_err = '{} should be {}'.format(name, ' or '.join(types))
+
+        def check_type(value):
+            if not isinstance(value, python_types) or (isinstance(value, bool) and not allow_bool):
+                return type_err
+        checks.append(check_type)
+    if 'enum' in schema:
+        enum = frozenset(schema['enum'])
+        enum_err = '{} should be one of {}'.format(name, ', '.join(map(str, schema['enum'])))
+
+        def check_enum(value):
+            if value not in enum:
+                return enum_err
+        checks.append(check_enum)
+    if 'maxLength' in schema or 'minLength' in schema:
+        max_length = schema.get('maxLength')
+        min_length = schema.get('minLength', 0)
+
+        def check_length(value):
+            if isinstance(value, str):
+                if max_length is not None and len(value) > max_length:
+                    return '{} is longer than {}'.format(name, max_length)
+                if len(value) < min_length:
+                    return '{} is shorter than {}'.format(name, min_length)
+        checks.append(check_length)
+    if 'minimum' in schema or 'maximum' in schema:
+        minimum = schema.get('minimum')
+        maximum = schema.get('maximum')
+
+        def check_range(value):
+            if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+                if minimum is not None and value < minimum:
+                    return '{} should be >= {}'.format(name, minimum)
+                if maximum is not None and value > maximum:
+                    return '{} should be <= {}'.format(name, maximum)
+        checks.append(check_range)
+    patterns = []
+    if 'pattern' in schema:
+        patterns.append(re.compile(schema['pattern']))
+    if fmt in DATE_PATTERNS:
+        patterns.append(DATE_PATTERNS[fmt])
+    if patterns:
+        pattern_err = '{} has an invalid format'.format(name)
+
+        def check_pattern(value):
+            if isinstance(value, str):
+                for pattern in patterns:
+                    if pattern.search(value) is None:
+                        return pattern_err
+        checks.append(check_pattern)
+
+    if not checks:
+        return None
+    if len(checks) == 1 and not nullable:
+        return checks[0]
+
+    def check(value):
+        if value is None and nullable:
+            return None
+        for c in checks:
+            err = c(value)
+            if err is not None:
+                return err
+    return check
+
+
+class CompiledSchema(object):
+    """
+    编译后的 schema 字段校验函数与必填字段
+    """
+
+    def __init__(self, schema: dict):
+        properties = schema.get('properties', {})
+        self.checks = {}
+        for name, prop in properties.items():
+            check = compile_property(name, prop)
+            if check is not None:
+                self.checks[name] = check
+        self.required = tuple(schema.get('required', ()))
+        self.known = frozenset(properties) if schema.get('additionalProperties', True) is False else None
+        self._keys = {}
+
+    def check_keys(self, keys: frozenset, partial: bool) -> str:
+        """
+        校验字段名 结果按字段集合缓存 批量数据中相同结构的行只检查一次
+        :param keys:
+        :param partial: 修改时不检查必填
+        :return:
+        """
+        cache_key = (keys, partial)
+        if cache_key in self._keys:
+            return self._keys[cache_key]
+        err = None
+        if self.known is not None:
+            unknown = sorted(keys - self.known)
+            if unknown:
+                err = 'unknown field {}'.format(', '.join(unknown))
+        if err is None and not partial:
+            for name in self.required:
+                if name not in keys:
+                    err = '{} is required'.format(name)
+                    break
+        if len(self._keys) < 1024:
+            self._keys[cache_key] = err
+        return err
+
+    def check(self, data, partial: bool = False) -> str:
+        if not isinstance(data, dict):
+            return 'data should be object'
+        err = self.check_keys(frozenset(data), partial)
+        if err is not None:
+            return err
+        checks = self.checks
+        for name, value in data.items():
+            check = checks.get(name)
+            if check is not None:
+                err = check(value)
+                if err is not None:
+                    return err
+        return None
+
+    def check_many(self, data_list: list) -> str:
+        for index, data in enumerate(data_list):
+            if not isinstance(data, dict):
+                return 'row {}: data should be object'.format(index)
+            err = self.check_keys(frozenset(data), False)
+            if err is not None:
+                return 'row {}: {}'.format(index, err)
+        # 按列校验 每列只查找一次校验函数
+        for name, check in self.checks.items():
+            for index, data in enumerate(data_list):
+                if name in data:
+                    err = check(data[name])
+                    if err is not None:
+                        return 'row {}: {}'.format(index, err)
+        return None
+
+
+class SchemaValidator(AbcValidator):
+    """
+    声明式校验 支持 json schema 的子集
+    (type enum minLength maxLength minimum maximum pattern format required additionalProperties)
+    用法:
+        class UserController(BaseController):
+            __dao__ = UserDao
+            # 根据表结构生成 (类型 长度 是否可空 必填)
+            __validator__ = SchemaValidator()
+            # 或者手写 schema (dict 会自动转换为 SchemaValidator)
+            __validator__ = {'properties': {'name': {'type': 'string', 'maxLength': 20}}, 'required': ['name']}
+    schema 在 controller 定义时编译 需要表结构时在表可用后编译
+    """
+
+    def __init__(self, schema: dict = None, from_table: bool = None):
+        """
+        :param schema: json schema 的子集
+        :param from_table: 是否根据 dao 的表生成 与 schema 同时使用时 schema 中的字段覆盖表生成的字段
+            默认在没有 schema 时根据表生成
+        """
+        self.schema = schema
+        self.from_table = schema is None if from_table is None else from_table
+        self.dao = None
+        self._compiled = None
+        if not self.from_table:
+            self._compiled = CompiledSchema(schema)
+
+    def bind(self, dao):
+        """
+        绑定 dao 由 ControllerMetaClass 调用 表已经反射时立即编译
+        :param dao:
+        :return:
+        """
+        self.dao = dao
+        if self.from_table:
+            self._compiled = None
+            try:
+                self.compile()
+            except (TypeError, KeyError, AttributeError):
+                # db 还没有 connect 第一次校验时再编译
+                pass
+
+    def compile(self) -> CompiledSchema:
+        schema = self.schema or {}
+        if self.from_table:
+            if self.dao is None:
+                raise ValueError('SchemaValidator without schema should be used as a controller __validator__')
+            derived = table_schema(self.dao.__db__[self.dao.__tablename__])
+            schema = dict(derived, **schema)
+            schema['properties'] = dict(derived['properties'], **(self.schema or {}).get('properties', {}))
+        self._compiled = CompiledSchema(schema)
+        return self._compiled
+
+    @property
+    def compiled(self) -> CompiledSchema:
+        if self._compiled is None:
+            return self.compile()
+        return self._compiled
+
+    def validate(self, data):
+        return self.compiled.check(data)
+
+    def validate_update(self, data):
+        return self.compiled.check(data, partial=True)
+
+    def validate_many(self, data_list):
+        return self.compiled.check_many(data_list)
@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+import easyapi
+from easyapi_tools.util import make_etag
+
+
+@pytest.fixture
+def item_dao(tmp_path):
+    path = str(tmp_path / 'items.db')
+    conn = sqlite3.connect(path)
+    conn.execute('create table items (id integer primary key, name varchar(20), updated_at datetime, '
+                 'updated_by varchar(20), deleted_at datetime, created_at datetime, created_by varchar(20))')
+    conn.executemany('insert into items (name, deleted_at) values (?, ?)',
+                     [(str(i), None) for i in range(9)] + [('deleted', '2020-01-01 00:00:00')])
+    conn.commit()
+    conn.close()
+    db = easyapi.SqliteDB(path)
+    db.connect()
+
+    class ItemDao(easyapi.BusinessBaseDao):
+        __db__ = db
+        __tablename__ = 'items'
+    return ItemDao
+
+
+def test_count_is_scoped_without_mutating_query(item_dao):
+    query = {}
+    assert item_dao.count(query=query) == 9
+    assert item_dao.count(query=query, unscoped=True) == 10
+    assert len(item_dao.query(query=query)) == 9
+    assert query == {}
+
+
+def test_controller_total_matches_rows(item_dao):
+    class ItemController(easyapi.BaseController):
+        __dao__ = item_dao
+
+    for _ in range(50):
+        query = {}
+        data, total = ItemController.query(query, {}, {})
+        assert (len(data), total) == (9, 9)
+        assert query == {}
+
+
+def test_etag_changes_after_delete(item_dao):
+    list_etag = make_etag('items', item_dao.version(query={}))
+    item_etag = make_etag('items', item_dao.version(query={'id': 1}))
+    assert item_dao.delete(where_dict={'id': 1}) == 1
+    assert item_dao.get(query={'id': 1}) is None
+    assert make_etag('items', item_dao.version(query={})) != list_etag
+    assert make_etag('items', item_dao.version(query={'id': 1})) != item_etag
+    assert item_dao.version(query={'id': 1}, unscoped=True)[1] is not None
@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+from async_easyapi import SyncController
+from easyapi import parallel, serial_calls
+
+
+def current_thread():
+    return threading.current_thread().name
+
+
+def test_parallel_uses_pool_threads():
+    names = parallel(current_thread, current_thread)
+    assert names[0] == current_thread()
+    assert names[1] != current_thread()
+
+
+def test_parallel_is_serial_inside_serial_calls():
+    with serial_calls():
+        assert parallel(current_thread, current_thread) == [current_thread()] * 2
+    assert parallel(current_thread, current_thread)[1] != current_thread()
+
+
+def test_sync_controller_runs_parallel_serially():
+    class Controller(object):
+        @classmethod
+        def query(cls):
+            return parallel(current_thread, current_thread)
+
+    controller = SyncController(Controller, max_workers=2)
+    try:
+        names = asyncio.run(controller.query())
+    finally:
+        controller.close()
+    assert names[0] == names[1] != current_thread()
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('flask', 'quart', 'sqlalchemy', 'aiomysql')
+
+
+def loaded_modules(code: str) -> list:
+    """
+    在新的解释器中执行 code 返回其中已加载的 web 框架和数据库驱动
+    """
+    code += '\nimport sys\nprint(",".join(m for m in {!r} if m in sys.modules))'.format(HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return [name for name in output.decode().strip().split(',') if name]
+
+
+@pytest.mark.parametrize('package', ['easyapi', 'async_easyapi', 'easyapi_tools'])
+def test_import_is_lazy(package):
+    assert loaded_modules('import {}'.format(package)) == []
+
+
+@pytest.mark.parametrize('package', ['easyapi', 'async_easyapi'])
+def test_util_exports_are_lazy(package):
+    code = ('import {0}\n'
+            'assert {0}.QueryStringUrlCondition.parser({{"a": "1"}})[0] == {{"a": "1"}}\n'
+            'assert {0}.make_etag(1) == {0}.make_etag(1)\n').format(package)
+    assert loaded_modules(code) == []
@@ -0,0 +1,56 @@
+import pytest
+from sqlalchemy import Boolean, Column, Integer, MetaData, Numeric, String, Table
+
+from easyapi_tools.errors import BusinessError
+from easyapi_tools.util import QueryStringUrlCondition, page_range
+
+users = Table('users', MetaData(), Column('id', Integer, primary_key=True), Column('name', String(20)),
+              Column('code', String(20)), Column('active', Boolean), Column('score', Numeric(10, 2)))
+
+
+class Args(object):
+    """
+    与 request.args 相同 同一个参数可以出现多次
+    """
+
+    def __init__(self, *pairs):
+        self.pairs = pairs
+
+    def keys(self):
+        return [key for key, _ in self.pairs]
+
+    def getlist(self, key):
+        return [value for k, value in self.pairs if k == key]
+
+
+def test_values_follow_column_types():
+    query, _, _ = QueryStringUrlCondition.parser(
+        Args(('name', 'null'), ('code', '123'), ('active', 'true'), ('_gt_id', '5'), ('_in_id', '1,2')), table=users)
+    assert query == {'name': 'null', 'code': '123', 'active': True, '_gt_id': 5, '_in_id': [1, 2]}
+    query, _, _ = QueryStringUrlCondition.parser(Args(('id', 'null'), ('score', '1.5')), table=users)
+    assert query['id'] is None and str(query['score']) == '1.5'
+
+
+def test_values_stay_strings_without_table():
+    query, _, _ = QueryStringUrlCondition.parser(Args(('id', '1'), ('id', '2'), ('active', 'true')))
+    assert query == {'_in_id': ['1', '2'], 'active': 'true'}
+
+
+@pytest.mark.parametrize('args', [Args(('id', 'abc')), Args(('active', 'maybe')), Args(('_page', '0')),
+                                  Args(('_page', '-1')), Args(('_per_page', 'abc'))])
+def test_invalid_values_are_bad_requests(args):
+    with pytest.raises(BusinessError) as error:
+        QueryStringUrlCondition.parser(args, table=users)
+    assert error.value.http_code == 400
+
+
+@pytest.mark.parametrize('pager', [{'_page': 0}, {'_page': -2, '_per_page': 10}, {'_per_page': 'abc'},
+                                   {'_page': True}])
+def test_page_range_rejects_invalid_pager(pager):
+    with pytest.raises(BusinessError):
+        page_range(pager)
+
+
+def test_page_range():
+    assert page_range({'_page': 2, '_per_page': 10}) == (10, 10)
+    assert page_range({'_page': '3'}) == (60, 30)